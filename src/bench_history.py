@@ -0,0 +1,79 @@
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+# Edit history micro-benchmark. Builds long flat programs in the code
+# editor, moves blocks around with a commit after every move, and reports
+# the time and the memory kept per undo step. Committed trees share all
+# but the edited paths (see rope.py), so the memory per step has to stay
+# small however long the program is; exits with 1 when it doesn't.
+# Run from the repository root: python src/bench_history.py
+
+sizes = (100, 1000, 10000)
+max_step_bytes = 8192
+
+
+def make_code():
+    import gui
+    import game
+    document = gui.LoaderXML("src/res/pages/level_layout.xml").get_document()
+    return game.Code(document)
+
+
+def measure(size: int, moves: int, seed: int = 0) -> tuple:
+    code = make_code()
+    rng = random.Random(seed)
+    code.load_program([rng.choice(("forward", "left", "right")) for _ in range(size)])
+    # Start from a warm history, so only the growth from the moves is seen
+    code.commit()
+    first = len(code.history.undo_stack)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter_ns()
+    for _ in range(moves):
+        index = rng.randrange(len(code.blocks))
+        block = code.blocks[index]
+        code.remove_block([index])
+        code.cursors = [rng.randint(0, len(code.blocks))]
+        code.place_block(block)
+        code.commit()
+    duration = time.perf_counter_ns() - start
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    steps = len(code.history.undo_stack) - first
+    return steps, duration / moves / 1000000, (after - before) / max(steps, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the code editor's undo history.")
+    parser.add_argument("-m", "--moves", type=int, default=500, help="moves made on each program")
+    args = parser.parse_args()
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+    import pygame
+    import gui
+    import game
+    import languages
+    pygame.init()
+    pygame.display.set_mode((800, 600))
+    gui.init("src/res/font/JetBrainsMono-Regular.ttf", 30)
+    game.init()
+    languages.load("src/res/lang/en-gb.yaml")
+
+    failed = False
+    print(f"{'blocks':>8}{'steps':>8}{'move':>10}{'bytes/step':>12}")
+    for size in sizes:
+        steps, move_ms, step_bytes = measure(size, args.moves)
+        print(f"{size:>8}{steps:>8}{move_ms:>10.3f}{step_bytes:>12.0f}")
+        if step_bytes > max_step_bytes:
+            print(f"  {size} blocks: {step_bytes:.0f} bytes per undo step, over {max_step_bytes}")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Layout micro-benchmarks. Builds synthetic pages (deep nesting, wide rows,
+# grids, every align mode and a random mix of lengths), times
+# DocumentXML.calc_draw and trace_element on them, and checks the layout
+# against a reference, so that layout changes can be compared safely.
+# Run from the repository root: python src/bench_layout.py
+
+# The reference layouts were checked against the original layout engine.
+# wide100, wide1000, grid30x30 and mixed match it as it was; deep32,
+# deep128 and aligns crash it with a division by zero in proportional
+# align, and match it once that alone is fixed.
+reference_file = "src/res/bench/layout_reference.json"
+sizes = ((800, 600), (1280, 720), (480, 900))
+lengths = ("auto", "min", "10%", "25%", "40px", "120px")
+margins = ("0px", "5px", "2%")
+aligns = {
+    "horizontal": ("before", "after", "centre", "distribute", "justify", "proportional", "left", "right"),
+    "vertical": ("before", "after", "centre", "distribute", "justify", "proportional", "up", "down"),
+}
+
+
+def attrs(**values) -> str:
+    return " ".join(f'{k}="{v}"' for k, v in values.items())
+
+
+def leaf(rng: random.Random, n: int) -> str:
+    if rng.random() < 0.5:
+        return f'<button {attrs(length=rng.choice(lengths), margin=rng.choice(margins))}>b{n}</button>'
+    return f'<space {attrs(length=rng.choice(lengths), margin=rng.choice(margins))}/>'
+
+
+def deep(depth: int, seed: int = 0) -> str:
+    # A chain of nested containers, alternating direction, each with a few
+    # siblings next to the nested one
+    rng = random.Random(seed)
+
+    def level(d: int) -> str:
+        tag = ("horizontal", "vertical")[d % 2]
+        inner = [leaf(rng, d * 3 + i) for i in range(2)]
+        if d < depth:
+            inner.insert(1, level(d + 1))
+        align = aligns[tag][d % len(aligns[tag])]
+        return f'<{tag} {attrs(align=align, length=rng.choice(lengths))}>{"".join(inner)}</{tag}>'
+
+    return level(0)
+
+
+def wide(count: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    children = "".join(leaf(rng, i) for i in range(count))
+    return f'<vertical><horizontal align="distribute">{children}</horizontal><space/></vertical>'
+
+
+def grid(rows: int, cols: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    out = []
+    for r in range(rows):
+        cells = "".join(leaf(rng, r * cols + c) for c in range(cols))
+        out.append(f'<horizontal {attrs(length="min", align=aligns["horizontal"][r % 8])}>{cells}</horizontal>')
+    return f'<vertical scrollable="true" align="before">{"".join(out)}</vertical>'
+
+
+def align_modes(seed: int = 0) -> str:
+    # One row and one column per align mode, with mixed lengths inside
+    rng = random.Random(seed)
+    out = []
+    for tag, modes in aligns.items():
+        for align in modes:
+            cells = "".join(leaf(rng, i) for i in range(4))
+            out.append(f'<{tag} {attrs(align=align, margin="5px")}>{cells}</{tag}>')
+    return f'<horizontal><vertical>{"".join(out[:8])}</vertical><horizontal>{"".join(out[8:])}</horizontal></horizontal>'
+
+
+def mixed(count: int, seed: int = 0) -> str:
+    # Random tree of containers and leaves
+    rng = random.Random(seed)
+    made = 0
+
+    def node(d: int) -> str:
+        nonlocal made
+        made += 1
+        if d > 1 and (d > 6 or rng.random() < 0.4 or made > count):
+            return leaf(rng, made)
+        tag = rng.choice(("horizontal", "vertical"))
+        inner = "".join(node(d + 1) for _ in range(rng.randint(1, 5)))
+        values = {"align": rng.choice(aligns[tag]), "length": rng.choice(lengths), "margin": rng.choice(margins)}
+        return f'<{tag} {attrs(**values)}>{inner}</{tag}>'
+
+    return node(0)
+
+
+def get_pages() -> dict:
+    return {
+        "deep32": deep(32),
+        "deep128": deep(128),
+        "wide100": wide(100),
+        "wide1000": wide(1000),
+        "grid30x30": grid(30, 30),
+        "aligns": align_modes(),
+        "mixed": mixed(400),
+    }
+
+
+def load(name: str, text: str, folder: str):
+    import gui
+    filename = os.path.join(folder, name + ".xml")
+    with open(filename, "w", encoding="utf-8") as file:
+        file.write(text)
+    return gui.LoaderXML(filename).get_document()
+
+
+def relayout(document, rect):
+    # Throw away every cached layout, so calc_draw does the full work
+    document.root.invalidate_tree()
+    document.layouts.clear()
+    document.area = None
+    document.calc_draw(rect)
+
+
+def digest(document) -> str:
+    # Every drawable's rect and bounding box, in drawing order
+    rects = [[e.tag, list(e.rect), list(e.bounding_box)] for e in document.drawables]
+    return hashlib.sha1(json.dumps(rects).encode()).hexdigest()
+
+
+def timed(func, repeat: int) -> float:
+    # Best of repeat runs, in milliseconds
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        func()
+        duration = time.perf_counter_ns() - start
+        best = duration if best is None else min(best, duration)
+    return best / 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark and check the gui layout engine.")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs per measurement, the best is kept")
+    parser.add_argument("-p", "--page", action="append", help="only run these pages")
+    parser.add_argument("--update-reference", action="store_true", help="save the current layouts as reference")
+    args = parser.parse_args()
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+    import pygame
+    import gui
+    import languages
+    pygame.init()
+    pygame.display.set_mode(sizes[0])
+    gui.init("src/res/font/JetBrainsMono-Regular.ttf", 30)
+    languages.load("src/res/lang/en-gb.yaml")
+
+    reference = dict()
+    if not args.update_reference and os.path.exists(reference_file):
+        with open(reference_file, encoding="utf-8") as file:
+            reference = json.load(file)
+    results = dict()
+    mismatches = 0
+    folder = tempfile.mkdtemp(prefix="codebot-bench-")
+    print(f"{'page':<12}{'elements':>9}{'full':>10}{'clean':>10}{'resize':>10}{'trace':>10}  (ms)")
+    for name, text in get_pages().items():
+        if args.page and name not in args.page:
+            continue
+        document = load(name, text, folder)
+        rects = [pygame.Rect(0, 0, *size) for size in sizes]
+        layouts = []
+        for rect in rects:
+            relayout(document, rect)
+            layouts.append(digest(document))
+        rng = random.Random(1)
+        points = [(rng.randrange(rects[0].w), rng.randrange(rects[0].h)) for _ in range(500)]
+
+        relayout(document, rects[0])
+        hits = []
+        for p in points:
+            elem = document.trace_element(p)
+            hits.append(-1 if elem is None else document.draw_index[elem])
+
+        full = timed(lambda: relayout(document, rects[0]), args.repeat)
+        clean = timed(lambda: document.calc_draw(rects[0]), args.repeat)
+
+        def resize():
+            # Alternates between sizes, which the layout cache keeps
+            for rect in rects:
+                document.calc_draw(rect)
+
+        resize()
+        resized = timed(resize, args.repeat) / len(rects)
+        document.calc_draw(rects[0])
+
+        def trace():
+            for p in points:
+                document.trace_element(p)
+
+        traced = timed(trace, args.repeat) / len(points)
+        print(f"{name:<12}{len(document.drawables):>9}{full:>10.3f}{clean:>10.3f}{resized:>10.3f}{traced:>10.4f}")
+
+        results[name] = {"layouts": layouts, "hits": hits}
+        if name in reference:
+            for size, expected, actual in zip(sizes, reference[name]["layouts"], layouts):
+                if expected != actual:
+                    print(f"  {name}: layout at {size[0]}x{size[1]} differs from the reference")
+                    mismatches += 1
+            if reference[name]["hits"] != hits:
+                print(f"  {name}: trace_element results differ from the reference")
+                mismatches += 1
+        elif not args.update_reference:
+            print(f"  {name}: no reference layout")
+
+    if args.update_reference:
+        os.makedirs(os.path.dirname(reference_file), exist_ok=True)
+        if os.path.exists(reference_file):
+            with open(reference_file, encoding="utf-8") as file:
+                reference = json.load(file)
+        reference.update(results)
+        with open(reference_file, "w", encoding="utf-8") as file:
+            json.dump(reference, file, separators=(",", ":"))
+        print(f"Reference saved to {reference_file}")
+    elif mismatches > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
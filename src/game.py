@@ -2,9 +2,13 @@ import pygame
 from pygame.image import load_extended
 import ticks
 import gui
-import yaml
+import inputs
 import math
 import languages
+import programs
+import progress
+import simulation
+from rope import Rope
 
 _font_code: pygame.font.Font
 _font_victory: pygame.font.Font
@@ -117,10 +121,14 @@ entity_res = 256
 entity_ground = 192
 click_threshold = 150
 step_delay = 200
+# Simulation speeds to pick from, 0 being instant
+speeds = (0.5, 1, 2, 4, 8, 16, 32, 64, 0)
 cursor_h = 16
 win_rot_speed = 0.03
 editor_scroll_speed = 40
 render_zoom_speed = .2
+preview_steps = 5000
+preview_colour = (255, 255, 255)
 
 # Each sprite uses a different dark colour against white bold text, and
 # two adjacent sprites have very distinct colours. This was made with
@@ -135,38 +143,12 @@ code_block_textures: list = [
     SlicedSprite(load_extended("src/res/textures/blocks/block_pink.png")),
 ]
 
-class Level:
+class Level(simulation.Level):
     def __init__(self, filename: str):
-        text: str
-        with open(filename, encoding='utf-8') as file:
-            text = file.read()
-        data = yaml.safe_load(text)
-        # Available blocks
-        self.blocks = data["blocks"]
-        # Map data
-        self.map = data["map"]
+        super().__init__(filename)
         # Map surface
-        self.height = len(self.map)
-        self.width = 0
-        if self.height > 0:
-            for row in self.map:
-                if len(row) != len(self.map[0]):
-                    raise ValueError("Invalid map, inconsistent row lengths.")
-            self.width = len(self.map[0])
         self.level_map = pygame.Surface((self.width * texture_res, self.height * texture_res), pygame.SRCALPHA)
 
-        player = data["player"]
-        self.start_x = player["start-x"]
-        self.start_y = player["start-y"]
-        self.start_dir = player["start-dir"]
-
-        stars = data["stars"]
-        self.min_coins = stars["coins"]
-        self.min_blocks = stars["blocks"]
-
-        # Level number
-        self.number = data["number"]
-
         for i in range(self.height):
             for j in range(self.width):
                 tile = self.map[i][j]
@@ -174,19 +156,15 @@ class Level:
                 dest = (j * texture_res, i * texture_res)
                 self.level_map.blit(texture_atlas, dest, area)
 
-    def get_block(self, x: int, y: int) -> int:
-        if x < 0 or x >= self.width or y < 0 or y >= self.height:
-            return 0
-        return self.map[y][x]
-
 
 class Game:
     def __init__(self):
         # Code
         self.code = None
         self.gen = None
-        self.steps = 1
-        self.code_start = 0
+        # Simulation time not yet run, in milliseconds at normal speed
+        self.accumulator = step_delay
+        self.speed = 1
         # Blocks (source)
         self.blocks = []
         # UI interactions
@@ -201,21 +179,23 @@ class Game:
         self.scroll = 1
         self.zoom = 1
         self.old_view = (0, 0)  # (yaw, pitch)
+        self.resized = False
         # UI integrations
         self.elem = None  # Container for rendering game scene
         self.level = None  # Current level object
         self.enabled = False  # false = in title screen
-        self.coins = []
         # Game
-        self.robot_x = 0
-        self.robot_y = 0
-        self.robot_dir = 0
+        self.robot = None
+        self.last_pos = (0, 0, 0)  # Robot (x, y, dir) before the last step
+        self.preview = None
+        self.drag_tree = None  # (block, tree, cursors, tree with the block)
         # Levels
         self.state = 0
-        self.coin_counter = 0
         # Level stats
-        self.unlocked_level = 1
-        self.levels = []
+        self.progress = progress.Store()
+        saved = self.progress.load()
+        self.unlocked_level = saved["unlocked"]
+        self.levels = saved["levels"]
 
     def enable(self, document: gui.DocumentXML, level: Level, screen: pygame.Surface):
         self.elem = document.ids["game"]
@@ -229,21 +209,23 @@ class Game:
         self.pitch = math.pi / 6
 
         self.code = Code(document)
-
-        self.robot_x = level.start_x
-        self.robot_y = level.start_y
-        self.robot_dir = level.start_dir
+        try:
+            self.code.load_program(programs.load(level.name))
+        except (ValueError, KeyError) as err:
+            print("Invalid saved program! " + str(err))
+        except OSError as err:
+            print("Could not load program! " + str(err))
+
+        self.robot = simulation.Robot(level)
+        self.last_pos = (self.robot.x, self.robot.y, self.robot.dir)
+        self.accumulator = step_delay
+        self.preview = Preview(level)
+        self.drag_tree = None
 
         btnlist: gui.Element = document.ids["blocklist"]
-        btnlist.children.clear()
+        btnlist.clear_children()
         self.blocks = []
 
-        self.coins = []
-        for i, row in enumerate(self.level.map):
-            for j, col in enumerate(row):
-                if col == 4:
-                    self.coins.append((j, i))
-
         for i, b in enumerate(level.blocks):
             block = defined_blocks[b]
             self.blocks.append(Blocklist(document, *block))
@@ -251,20 +233,27 @@ class Game:
         for b in self.blocks:
             b.update()
         document.calc_draw(screen.get_clip())
-        document.hover_element = document.trace_element(pygame.mouse.get_pos())
+        document.hover_element = document.trace_element(inputs.get_mouse_pos())
 
     def disable(self):
+        if self.enabled:
+            try:
+                programs.save(self.level.name, self.code.get_program())
+            except OSError as err:
+                print("Could not save program! " + str(err))
         self.elem = None
         self.level = None
         self.enabled = False
         self.state = 0
         self.gen = None
         self.blocks = []
+        self.preview = None
+        self.drag_tree = None
 
     def handle_event(self, _: pygame.Surface, event: pygame.event.Event):
         if not self.enabled:
             return
-        mpos = pygame.mouse.get_pos()
+        mpos = inputs.get_mouse_pos()
 
         if event.type == pygame.MOUSEBUTTONDOWN:
             if event.button == 1:
@@ -287,7 +276,10 @@ class Game:
                         if ret is not None:
                             self.click_type = 3
                             self.block_dragged = ret[1]
-                            self.block_offset = (mpos[0] - ret[1].pos.x - rect.x, mpos[1] - ret[1].pos.y - rect.y)
+                            self.block_offset = (
+                                mpos[0] - ret[1].pos.x - rect.x,
+                                mpos[1] - ret[1].pos.y - rect.y - self.code.scroll
+                            )
                             self.code.remove_block(ret[0])
             elif event.button == 4:
                 if self.elem.rect.collidepoint(mpos):
@@ -311,46 +303,62 @@ class Game:
                     self.code.place_block(self.block_dragged)
             self.click_type = 0
             self.click_start = -1
+            self.code.commit()
+        elif event.type == pygame.KEYDOWN and self.click_type == 0:
+            if event.mod & pygame.KMOD_CTRL:
+                if event.key == pygame.K_z and event.mod & pygame.KMOD_SHIFT:
+                    self.code.redo()
+                elif event.key == pygame.K_z:
+                    self.code.undo()
+                elif event.key == pygame.K_y:
+                    self.code.redo()
         elif event.type == pygame.VIDEORESIZE:
-            lvl_size = max(self.level.width, self.level.height) * texture_res
-            self.zoom = min(self.elem.rect.w / 2, self.elem.rect.h / 2) / lvl_size
+            # Applied in update, once the document has been laid out again
+            self.resized = True
 
     def lose(self):
         self.gen = None
         self.state = 2
 
     def win(self):
-        self.unlocked_level = max(self.unlocked_level, self.level.number + 1)
+        if self.level.number + 1 > self.unlocked_level:
+            self.unlocked_level = self.level.number + 1
+            self.progress.unlock(self.unlocked_level)
         self.gen = None
         self.state = 1
 
-        level_stats = (
-            True,
-            self.code.get_block_count() <= self.level.min_blocks,
-            self.coin_counter >= self.level.min_coins
-        ).count(True)
+        level_stats = simulation.get_stars(self.level, self.robot, self.code.get_block_count())
         level_idx = self.level.number - 1
         if level_idx < len(self.levels):
-            self.levels[level_idx] = max(level_stats, self.levels[level_idx])
+            if level_stats > self.levels[level_idx]:
+                self.levels[level_idx] = level_stats
+                self.progress.set_stars(level_idx, level_stats)
         elif level_idx == len(self.levels):
             self.levels.append(level_stats)
+            self.progress.set_stars(level_idx, level_stats)
 
     def update(self):
         if not self.enabled:
             return
-        mpos = pygame.mouse.get_pos()
-        now = ticks.get_time()
+        mpos = inputs.get_mouse_pos()
+        if self.resized:
+            self.resized = False
+            lvl_size = max(self.level.width, self.level.height) * texture_res
+            self.zoom = min(self.elem.rect.w / 2, self.elem.rect.h / 2) / lvl_size
         for b in self.blocks:
             b.update()
         self.code.update()
-        if self.gen is not None:
-            if self.steps * step_delay < now - self.code_start:
-                try:
-                    move = next(self.gen)
-                    self.move_bot(move)
-                    self.steps += 1
-                except StopIteration:
-                    self.gen = None
+        if self.speed == 0:
+            self.finish_run()
+        elif self.gen is not None:
+            # Run every step that is due, however many that is
+            self.accumulator += max(ticks.get_variation(), 0) * self.speed
+            while self.gen is not None and self.accumulator >= step_delay:
+                self.accumulator -= step_delay
+                self.step()
+        elif self.accumulator < step_delay:
+            # Finish showing the last step
+            self.accumulator = min(self.accumulator + max(ticks.get_variation(), 0) * self.speed, step_delay)
         if self.state > 0:
             self.update_position(self.yaw + win_rot_speed)
         if self.click_start > -1:
@@ -380,6 +388,25 @@ class Game:
                 self.block_dragged.update(None, self.block_dragged.pos.topleft)
                 if self.code.elem.rect.collidepoint(mpos):
                     self.code.cursor_closest(mpos)
+        self.preview.update(self.get_preview_tree(mpos))
+
+    def get_preview_tree(self, mpos: tuple) -> Rope:
+        # While a block is dragged over the editor, preview the program as
+        # if it was dropped at the cursor. The tree is only rebuilt when the
+        # cursor moves to another insertion point.
+        if self.click_start == -1 or not self.code.elem.rect.collidepoint(mpos):
+            return self.code.tree
+        if self.click_type == 2:
+            if ticks.get_time() - self.click_start < click_threshold:
+                return self.code.tree
+        elif self.click_type != 3:
+            return self.code.tree
+        cached = self.drag_tree
+        if (cached is None or cached[0] is not self.block_dragged or cached[1] is not self.code.tree
+                or cached[2] != self.code.cursors):
+            tree = insert_node(self.code.tree, self.code.cursors, block_node(self.block_dragged))
+            self.drag_tree = (self.block_dragged, self.code.tree, list(self.code.cursors), tree)
+        return self.drag_tree[3]
 
     def update_position(self, yaw=None, pitch=None, zoom=None):
         if yaw:
@@ -389,54 +416,54 @@ class Game:
         if zoom:
             self.zoom = zoom
 
-    def run_code(self):
-        self.code_start = ticks.get_time()
-        self.gen = self.code.exec()
-        self.steps = 1
+    def next_speed(self):
+        self.speed = speeds[(speeds.index(self.speed) + 1) % len(speeds)]
+        if self.speed == 0 and self.gen is not None:
+            self.finish_run()
 
-        self.robot_x = self.level.start_x
-        self.robot_y = self.level.start_y
-        self.robot_dir = self.level.start_dir
+    def get_speed_label(self) -> str:
+        if self.speed == 0:
+            return "level.speed_instant"
+        return f"{self.speed:g}x"
 
+    def run_code(self):
         self.state = 0
-        self.coins = []
-        self.coin_counter = 0
-        for i, row in enumerate(self.level.map):
-            for j, col in enumerate(row):
-                if col == 4:
-                    self.coins.append((j, i))
+        if self.speed == 0:
+            # Only the outcome is shown, so it may come from the cache
+            self.gen = None
+            self.robot = simulation.run_cached(self.level, self.code.get_program())
+            self.last_pos = (self.robot.x, self.robot.y, self.robot.dir)
+            self.accumulator = step_delay
+            if self.robot.state == 2:
+                self.lose()
+            elif self.robot.state == 1:
+                self.win()
+            return
+        self.gen = self.code.exec()
+        self.robot = simulation.Robot(self.level)
+        self.last_pos = (self.robot.x, self.robot.y, self.robot.dir)
+        self.accumulator = 0
+
+    def finish_run(self):
+        # Instant speed: whatever is left of the current run happens now,
+        # and the robot is shown where it ended up
+        while self.gen is not None:
+            self.step()
+        self.last_pos = (self.robot.x, self.robot.y, self.robot.dir)
+        self.accumulator = step_delay
+
+    def step(self):
+        self.last_pos = (self.robot.x, self.robot.y, self.robot.dir)
+        try:
+            self.move_bot(next(self.gen))
+        except StopIteration:
+            self.gen = None
 
     def move_bot(self, move):
-        old_pos = self.robot_x, self.robot_y
-        if move == "forward":
-            pos_offset = (
-                (0, -1),
-                (-1, 0),
-                (0, 1),
-                (1, 0),
-            )[self.robot_dir]
-            self.robot_x += pos_offset[0]
-            self.robot_y += pos_offset[1]
-        elif move == "left":
-            self.robot_dir = (self.robot_dir + 1) % 4
-        elif move == "right":
-            self.robot_dir = (self.robot_dir - 1) % 4
-
-        block = self.level.get_block(self.robot_x, self.robot_y)
-
-        collected = None
-        for c in self.coins:
-            if (self.robot_x, self.robot_y) == c:
-                collected = c
-        if collected is not None:
-            self.coins.remove(collected)
-            self.coin_counter += 1
-
-        if block == 0:
-            self.robot_x, self.robot_y = old_pos
-        elif block == 1:
+        self.robot.move(self.level, move)
+        if self.robot.state == 2:
             self.lose()
-        elif block == 3:
+        elif self.robot.state == 1:
             self.win()
 
     def draw(self, screen: pygame.Surface):
@@ -489,8 +516,14 @@ class Game:
         # pos_y = self.elem.rect.y + (self.elem.rect.h / 2)
         pos_x = self.elem.rect.w / 2
         pos_y = self.elem.rect.h / 2
+        # Robot between its last two positions, for smooth movement
+        alpha = min(self.accumulator / step_delay, 1)
+        last_x, last_y, last_dir = self.last_pos
+        robot_x = last_x + (self.robot.x - last_x) * alpha
+        robot_y = last_y + (self.robot.y - last_y) * alpha
+        robot_dir = last_dir + ((self.robot.dir - last_dir + 2) % 4 - 2) * alpha
         # Scale robot sprite
-        angle = ((self.yaw + self.robot_dir * math.pi / 2 + math.pi * 9 / 8) % (math.pi * 2)) * 8 / (math.pi * 2)
+        angle = ((self.yaw + robot_dir * math.pi / 2 + math.pi * 9 / 8) % (math.pi * 2)) * 8 / (math.pi * 2)
         bot_render = robot_atlas.subsurface(
             pygame.Rect(
                 int(angle) * entity_res,
@@ -511,14 +544,14 @@ class Game:
         ).copy()
         # Entities
         entities = []
-        for c in self.coins:
+        for c in self.robot.coins:
             entities.append(
                 (pygame.transform.rotozoom(coin_render, 0, true_zoom / (entity_res / 32)), *c)
             )
         entities.append((
             pygame.transform.rotozoom(bot_render, 0, true_zoom / (entity_res / 32)),
-            self.robot_x,
-            self.robot_y,
+            robot_x,
+            robot_y,
         ))
         to_render = []
         for e in entities:
@@ -529,6 +562,15 @@ class Game:
         # Rendering
         dest.blit(map_render, (pos_x - map_render.get_width() / 2, pos_y - map_render.get_height() / 2))
 
+        if len(self.preview.points) > 1:
+            points = []
+            for p in self.preview.points:
+                pos_real = (p[0] - self.level.width / 2 + .5, p[1] - self.level.height / 2 + .5)
+                points.append(x_axis * pos_real[0] + y_axis * pos_real[1] + pygame.math.Vector2(pos_x, pos_y))
+            width = max(int(true_zoom * 4), 1)
+            pygame.draw.lines(dest, preview_colour, False, points, width)
+            pygame.draw.circle(dest, preview_colour, points[-1], width * 2)
+
         for e in to_render:
             # print(e)
             dest.blit(
@@ -540,6 +582,62 @@ class Game:
             )
 
 
+def node_moves(node):
+    # Moves of a block in the edit history (see block_node)
+    if type(node) is tuple:
+        container, children = node
+        container: CodeContainer
+        for i in range(container.times):
+            for c in children:
+                yield from node_moves(c)
+    else:
+        yield node.name
+
+
+class Preview:
+    # Path the program in the editor would take, drawn over the map. The
+    # robot is saved at the start of every top level block, so after an
+    # edit only the blocks from the first changed one onwards are run.
+    def __init__(self, level: Level):
+        self.level = level
+        self.nodes = Rope()
+        # starts[i] is the robot before block i, paths[i] the tiles it
+        # entered during block i
+        self.starts = [simulation.Robot(level)]
+        self.paths = []
+        self.points = [(level.start_x, level.start_y)]
+
+    def update(self, nodes: Rope):
+        # Unchanged blocks keep their nodes, see Code.edit_tree
+        if nodes is self.nodes:
+            return
+        first = 0
+        for a, b in zip(nodes, self.nodes):
+            if first == len(self.paths) or a is not b:
+                break
+            first += 1
+        del self.starts[first + 1:]
+        del self.paths[first:]
+        robot = self.starts[first].copy()
+        for node in nodes.iter_from(first):
+            if robot.state > 0 or robot.steps >= preview_steps:
+                break
+            path = []
+            for move in node_moves(node):
+                last = robot.x, robot.y
+                robot.move(self.level, move)
+                if (robot.x, robot.y) != last:
+                    path.append((robot.x, robot.y))
+                if robot.state > 0 or robot.steps >= preview_steps:
+                    break
+            self.paths.append(path)
+            self.starts.append(robot.copy())
+        self.nodes = nodes
+        self.points = [(self.level.start_x, self.level.start_y)]
+        for path in self.paths:
+            self.points.extend(path)
+
+
 # Source of blocks, from which they spawn and get dragged out of
 class Blocklist:
     def __init__(self, document: gui.DocumentXML, block_name: str, colour: int = 0, container: bool = False, times=4):
@@ -566,7 +664,10 @@ class Blocklist:
     def update(self):
         self.block.pos = self.elem.rect
         self.block.pos = pygame.Rect(self.elem.rect.move(-48, -48))
-        self.elem.length = f"{self.block.get_box().w}px"
+        length = gui.Length("px", self.block.get_box().w)
+        if self.elem.length != length:
+            self.elem.length = length
+            self.elem.invalidate()
 
     def draw(self, screen: pygame.Surface):
         self.block.draw(screen)
@@ -581,27 +682,81 @@ defined_blocks = {
 }
 
 
+def label_size(name: str) -> tuple:
+    # Text size of a block label, cached until the language or font changes
+    global label_version, _label_env
+    env = (languages.version, id(_font_code))
+    if env != _label_env:
+        _label_env = env
+        _label_sizes.clear()
+        label_version += 1
+    size = _label_sizes.get(name)
+    if size is None:
+        size = _font_code.size(languages.get_str("level.blocks." + name))
+        _label_sizes[name] = size
+    return size
+
+
+label_version = 0
+_label_env = None
+_label_sizes = dict()
+
+
+def collect_visible(view: pygame.Rect, blocks: list, off: tuple, blits: list):
+    # Blocks in a list are stacked top to bottom, so the ones inside the
+    # view form a run that starts where a binary search finds it
+    top = view.top - off[1]
+    bottom = view.bottom - off[1]
+    lo, hi = 0, len(blocks)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if blocks[mid].get_box().bottom <= top:
+            lo = mid + 1
+        else:
+            hi = mid
+    for b in blocks[lo:]:
+        b: Codeblock
+        if b.pos.y >= bottom:
+            break
+        b.collect(view, off, blits)
+
+
 class Codeblock:
     def __init__(self, sprite: SlicedSprite, name: str, pos: pygame.Rect):
         self.sprite = sprite
         self.name = name
         self.pos = pos
+        # Sprite and label, composed once and
+        # redrawn only when the label or the size changes
+        self.surface = None
+        self.surface_key = None
 
-    def draw(self, screen: pygame.Surface):
+    def draw(self, screen: pygame.Surface, off: tuple = (0, 0)):
+        blits = []
+        self.collect(screen.get_clip(), off, blits)
+        screen.blits(blits, False)
+
+    def collect(self, view: pygame.Rect, off: tuple, blits: list):
+        blits.append((self.get_surface(), self.pos.move(off)))
+
+    def get_surface(self) -> pygame.Surface:
         text = languages.get_str("level.blocks." + self.name)
-        size = _font_code.size(text)
+        box = self.get_box()
+        key = (text, box.size, label_version)
+        if self.surface_key != key:
+            self.surface = pygame.Surface(box.size, pygame.SRCALPHA)
+            self.compose(self.surface, text)
+            self.surface_key = key
+        return self.surface
+
+    def compose(self, surface: pygame.Surface, text: str):
+        size = label_size(self.name)
         size = (size[0] - 32, size[1] - 32)
-        self.sprite.draw(screen, self.pos, size)
-        draw_text(
-            screen,
-            pygame.Rect(self.pos.x + 16, self.pos.y + 16, 0, 0),
-            text,
-            0xFFFFFFFF,
-            _font_code
-        )
+        self.sprite.draw(surface, pygame.Rect(0, 0, 0, 0), size)
+        draw_text(surface, pygame.Rect(16, 16, 0, 0), text, 0xFFFFFFFF, _font_code)
 
     def get_box(self, off: tuple = (0, 0)) -> pygame.Rect:
-        size = _font_code.size(languages.get_str("level.blocks." + self.name))
+        size = label_size(self.name)
         return pygame.Rect(
             self.pos.x + off[0],
             self.pos.y + off[1],
@@ -612,6 +767,9 @@ class Codeblock:
     def update(self, cursors, off: tuple):
         pass
 
+    def translate(self, dx: int, dy: int):
+        self.pos = self.pos.move(dx, dy)
+
 
 class CodeContainer(Codeblock):
     def __init__(self, sprite: SlicedSprite, name: str, pos: pygame.Rect, times):
@@ -619,23 +777,24 @@ class CodeContainer(Codeblock):
         self.children = []
         self.height = 0
         self.times = times
-
-    def draw(self, screen: pygame.Surface):
-        for i, b in enumerate(self.children):
-            b: Codeblock
-            b.draw(screen)
-
-        text = languages.get_str("level.blocks." + self.name)
-        size = _font_code.size(text)
+        # Layout cache: children are only placed again when an edit or a
+        # cursor move happens inside this container (dirty), otherwise
+        # they are just shifted along with it
+        self.dirty = True
+        self.laid_at = None
+        self.laid_version = -1
+        # Children as they appear in the edit history (see block_node)
+        self.snapshot = Rope()
+
+    def collect(self, view: pygame.Rect, off: tuple, blits: list):
+        collect_visible(view, self.children, off, blits)
+        super().collect(view, off, blits)
+
+    def compose(self, surface: pygame.Surface, text: str):
+        size = label_size(self.name)
         size = (size[0] - 32, size[1] + self.height)
-        self.sprite.draw(screen, self.pos, size, self.height)
-        draw_text(
-            screen,
-            pygame.Rect(self.pos.x + 16, self.pos.y + 16, 0, 0),
-            text,
-            0xFFFFFFFF,
-            _font_code
-        )
+        self.sprite.draw(surface, pygame.Rect(0, 0, 0, 0), size, self.height)
+        draw_text(surface, pygame.Rect(16, 16, 0, 0), text, 0xFFFFFFFF, _font_code)
 
     def get_block_count(self):
         count = 0
@@ -646,9 +805,23 @@ class CodeContainer(Codeblock):
             count += 1
         return count
 
+    def get_origin(self) -> tuple:
+        # Top left corner of the children area
+        return self.pos.x + 32, self.pos.y + 32 + label_size(self.name)[1]
+
     def update(self, cursors, off: tuple):
+        if not self.dirty and self.laid_at is not None and self.laid_version == label_version:
+            if self.laid_at != off:
+                dx, dy = off[0] - self.laid_at[0], off[1] - self.laid_at[1]
+                for b in self.children:
+                    b.translate(dx, dy)
+                self.laid_at = off
+            return
+        self.dirty = False
+        self.laid_at = off
+        self.laid_version = label_version
         current_y = 0
-        size = _font_code.size(languages.get_str("level.blocks." + self.name))
+        size = label_size(self.name)
         off = (off[0] + 32, off[1] + 32 + size[1])
         for i, b in enumerate(self.children):
             b: Codeblock
@@ -666,24 +839,19 @@ class CodeContainer(Codeblock):
             current_y += cursor_h
         self.height = current_y
 
-    def draw_cursor(self, screen: pygame.Surface, cursors, off: tuple):
-        current_y = 0
-        size = _font_code.size(languages.get_str("level.blocks." + self.name))
-        off = (off[0] + 32, off[1] + 32 + size[1])
-        for i, b in enumerate(self.children):
-            b: Codeblock
-            if cursors is not None and len(cursors) > 0 and cursors[0] == i:
-                if len(cursors) == 1:
-                    fill_rect(screen, pygame.Rect(off[0], off[1] + current_y, 1000, cursor_h), 0xFFFFFF1F)
-                    current_y += cursor_h
-                n_off = (off[0], off[1] + current_y)
-                if type(b) is CodeContainer:
-                    b: CodeContainer
-                    b.draw_cursor(screen, cursors[1:], n_off)
-            current_y += b.get_box().h
-        if cursors is not None and len(cursors) > 0 and cursors[0] == len(self.children):
-            fill_rect(screen, pygame.Rect(off[0], off[1] + current_y, 1000, cursor_h), 0xFFFFFF1F)
-            current_y += cursor_h
+    def translate(self, dx: int, dy: int):
+        super().translate(dx, dy)
+        if self.laid_at is not None:
+            self.laid_at = (self.laid_at[0] + dx, self.laid_at[1] + dy)
+        for b in self.children:
+            b.translate(dx, dy)
+
+    def invalidate_tree(self):
+        self.dirty = True
+        for b in self.children:
+            if type(b) is CodeContainer:
+                b: CodeContainer
+                b.invalidate_tree()
 
     def trace_block(self, pos: tuple, off: tuple):
         for i, b in enumerate(self.children):
@@ -702,7 +870,7 @@ class CodeContainer(Codeblock):
 
     def cursor_closest(self, pos: tuple, off: pygame.Rect, stack: list):
         vpos = pygame.Vector2(pos)
-        size = _font_code.size(languages.get_str("level.blocks." + self.name))
+        size = label_size(self.name)
         closest = [*stack, 0]
         closest_dis = pygame.Vector2(
             self.pos.x + off.x,
@@ -733,7 +901,7 @@ class CodeContainer(Codeblock):
         return closest, closest_dis
 
     def get_box(self, off: tuple = (0, 0)) -> pygame.Rect:
-        size = _font_code.size(languages.get_str("level.blocks." + self.name))
+        size = label_size(self.name)
         return pygame.Rect(
             self.pos.x + off[0],
             self.pos.y + off[1],
@@ -752,12 +920,96 @@ class CodeContainer(Codeblock):
                 yield b.name
 
 
+def make_block(name: str) -> Codeblock:
+    block = defined_blocks[name]
+    sprite = code_block_textures[block[1]]
+    if block[2]:
+        return CodeContainer(sprite, block[0], pygame.Rect(0, 0, 0, 0), block[3])
+    return Codeblock(sprite, block[0], pygame.Rect(0, 0, 0, 0))
+
+
+def block_node(block: Codeblock):
+    # Immutable view of a block for the edit history: a container becomes
+    # a (container, children) pair, with its children as a Rope of nodes
+    if type(block) is CodeContainer:
+        block: CodeContainer
+        return block, block.snapshot
+    return block
+
+
+def insert_node(nodes: Rope, path: list, node) -> Rope:
+    # A copy of a tree with node inserted at a cursor path, sharing every
+    # node off the path
+    i = path[0]
+    if len(path) == 1:
+        return nodes.insert(i, node)
+    container, children = nodes[i]
+    return nodes.replace(i, (container, insert_node(children, path[1:], node)))
+
+
+def restore_nodes(blocks: list, nodes: Rope):
+    # Bring a list of blocks back to a snapshot. Snapshots share unchanged
+    # subtrees, so only containers whose children differ are visited.
+    blocks[:] = [n[0] if type(n) is tuple else n for n in nodes]
+    for n in nodes:
+        if type(n) is tuple and n[0].snapshot is not n[1]:
+            container, children = n
+            container: CodeContainer
+            restore_nodes(container.children, children)
+            container.snapshot = children
+            container.dirty = True
+
+
+class History:
+    def __init__(self, state: tuple):
+        # States are (tree, cursors) pairs, see Code.commit
+        self.state = state
+        self.undo_stack = []
+        self.redo_stack = []
+
+    def commit(self, state: tuple):
+        # Equal trees share almost all of their nodes, so this comparison
+        # only goes down the edited paths. Moving only the cursor isn't an
+        # edit, but is kept so that undoing back to here puts it there.
+        if state[0] == self.state[0]:
+            self.state = state
+            return
+        self.undo_stack.append(self.state)
+        self.redo_stack.clear()
+        self.state = state
+
+    def undo(self):
+        if len(self.undo_stack) == 0:
+            return None
+        self.redo_stack.append(self.state)
+        self.state = self.undo_stack.pop()
+        return self.state
+
+    def redo(self):
+        if len(self.redo_stack) == 0:
+            return None
+        self.undo_stack.append(self.state)
+        self.state = self.redo_stack.pop()
+        return self.state
+
+
 class Code:
     def __init__(self, document: gui.DocumentXML):
         self.elem: gui.Element = document.ids["code"]
         self.scroll = 0
         self.blocks = []
         self.cursors = [0]  # For nested blocks
+        # Block positions don't include the scroll offset, and are only
+        # recalculated after edits, cursor moves or a language change
+        self.dirty = True
+        self.label_version = -1
+        # Insertion points (see build_cursor_points), rebuilt after edits
+        self.cursor_points = None
+        # The program as an immutable tree of nodes (see block_node). Edits
+        # copy only O(log n) rope nodes per container along the edited
+        # path, so every committed state can be kept for undo.
+        self.tree = Rope()
+        self.history = History((self.tree, [0]))
 
     def get_block_count(self):
         count = 0
@@ -768,7 +1020,38 @@ class Code:
             count += 1
         return count
 
+    def get_offset(self) -> tuple:
+        # Screen position of the editor's origin
+        return self.elem.rect.x, self.elem.rect.y + self.scroll
+
+    def invalidate_path(self, path: list):
+        # Mark the containers along a path (to a block or cursor) for layout
+        self.dirty = True
+        context = self.blocks
+        for c in path[:-1]:
+            if c >= len(context) or type(context[c]) is not CodeContainer:
+                return
+            context[c].dirty = True
+            context = context[c].children
+
+    def edit_tree(self, path: list, edit):
+        # Apply edit(nodes, index) to the snapshot of the list at the end of
+        # the path, and copy the containers leading to it
+        def walk(blocks: list, nodes: Rope, sub: list) -> Rope:
+            if len(sub) == 1:
+                return edit(nodes, sub[0])
+            i = sub[0]
+            container: CodeContainer = blocks[i]
+            container.snapshot = walk(container.children, container.snapshot, sub[1:])
+            return nodes.replace(i, (container, container.snapshot))
+
+        self.tree = walk(self.blocks, self.tree, path)
+
     def place_block(self, block: Codeblock):
+        self.invalidate_path(self.cursors)
+        self.cursor_points = None
+        node = block_node(block)
+        self.edit_tree(self.cursors, lambda nodes, i: nodes.insert(i, node))
         context = self.blocks
         for c in self.cursors[:-1]:
             context = context[c].children
@@ -776,21 +1059,77 @@ class Code:
         self.cursors[-1] += 1
 
     def remove_block(self, index: list):
+        self.cursor_points = None
+        self.invalidate_path(index)
+        self.invalidate_path(self.cursors)
+        self.edit_tree(index, lambda nodes, i: nodes.delete(i))
         context = self.blocks
         for c in index[:-1]:
             context = context[c].children
         if index[-1] < self.cursors[-1]:
             self.cursors[-1] -= 1
         context.pop(index[-1])
+        # Indices after the removed block shift, so the cursor may now
+        # lead through other containers
+        self.invalidate_path(self.cursors)
+
+    def commit(self):
+        # Record the program as one step of the edit history
+        self.history.commit((self.tree, list(self.cursors)))
+
+    def restore(self, state: tuple):
+        if state is None:
+            return
+        tree, cursors = state
+        self.invalidate_path(self.cursors)
+        self.cursor_points = None
+        restore_nodes(self.blocks, tree)
+        self.tree = tree
+        self.cursors = list(cursors)
+        self.invalidate_path(self.cursors)
+
+    def undo(self):
+        self.restore(self.history.undo())
+
+    def redo(self):
+        self.restore(self.history.redo())
+
+    def get_program(self) -> list:
+        # The program as nested lists of block names, see programs.py
+        def walk(nodes: Rope) -> list:
+            return [(n[0].name, walk(n[1])) if type(n) is tuple else n.name for n in nodes]
+
+        return walk(self.tree)
+
+    def load_program(self, program: list):
+        # Build the whole tree before laying it out, which then happens
+        # only once, in the next update
+        def build(items: list) -> tuple:
+            blocks = []
+            for item in items:
+                if type(item) is tuple:
+                    name, children = item
+                    block: CodeContainer = make_block(name)
+                    block.children, block.snapshot = build(children)
+                else:
+                    block = make_block(item)
+                blocks.append(block)
+            return blocks, Rope(block_node(b) for b in blocks)
+
+        self.blocks, self.tree = build(program)
+        self.cursors = [len(self.blocks)]
+        self.dirty = True
+        self.cursor_points = None
+        self.history = History((self.tree, list(self.cursors)))
 
     def trace_block(self, pos: tuple):
+        off = self.get_offset()
         for i, b in enumerate(self.blocks):
             b: Codeblock
-            rect: pygame.Rect = self.elem.rect
-            if b.get_box(rect.topleft).collidepoint(pos):
+            if b.get_box(off).collidepoint(pos):
                 if type(b) is CodeContainer:
                     b: CodeContainer
-                    ret = b.trace_block(pos, rect.topleft)
+                    ret = b.trace_block(pos, off)
                     if ret is None:
                         return [i], b
                     else:
@@ -799,36 +1138,107 @@ class Code:
                     return [i], b
         return None
 
+    def build_cursor_points(self):
+        # Every insertion point in preorder, which is also top to bottom:
+        # each block's top left corner, each container's children origin,
+        # and the bottom of each list. The cursor gap is taken out of the
+        # stored heights, so moving the cursor doesn't require a rebuild.
+        ys, xs, paths = [], [], []
+        orders = dict()
+
+        def add(kind: str, path: tuple, x: int, y: int):
+            orders[(kind, path)] = len(ys)
+            ys.append(y)
+            xs.append(x)
+            paths.append(list(path))
+
+        def walk(blocks: list, stack: tuple):
+            for i, b in enumerate(blocks):
+                b: Codeblock
+                add("block", (*stack, i), b.pos.x, b.pos.y)
+                if type(b) is CodeContainer:
+                    b: CodeContainer
+                    add("origin", (*stack, i, 0), b.pos.x, b.get_origin()[1])
+                    walk(b.children, (*stack, i))
+            if len(blocks) > 0:
+                last_b = blocks[-1]
+                add("end", (*stack, len(blocks)), last_b.pos.x, last_b.pos.y + last_b.get_box().h)
+
+        walk(self.blocks, ())
+        self.cursor_points = (ys, xs, paths, orders)
+        for i in range(self.gap_start(), len(ys)):
+            ys[i] -= cursor_h
+
+    def gap_start(self) -> int:
+        # Index of the first insertion point below the cursor gap
+        _, _, paths, orders = self.cursor_points
+        path = tuple(self.cursors)
+        if ("block", path) in orders:
+            return orders[("block", path)]
+        if ("end", path) in orders:
+            return orders[("end", path)] + 1
+        if ("origin", path) in orders and path[-1] == 0:
+            # Empty container
+            return orders[("origin", path)] + 1
+        return len(paths)
+
     def cursor_closest(self, pos: tuple):
-        vpos = pygame.Vector2(pos)
-        closest = [0]
+        self.update()
+        if self.cursor_points is None:
+            self.build_cursor_points()
+        ys, xs, paths, _ = self.cursor_points
+        if len(ys) == 0:
+            self.set_cursor([0])
+            return [0], None
+        gap = self.gap_start()
+        off = self.get_offset()
+        px, py = pos[0] - off[0], pos[1] - off[1]
+
+        def point_y(n: int) -> int:
+            return ys[n] + cursor_h if n >= gap else ys[n]
+
+        # Binary search for the first point at or below the mouse, then
+        # widen both ways until points are too far away vertically
+        lo, hi = 0, len(ys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if point_y(mid) < py:
+                lo = mid + 1
+            else:
+                hi = mid
         closest_dis = None
-        for i, b in enumerate(self.blocks):
-            b: Codeblock
-            block_pos = (b.pos.x + self.elem.rect.x, b.pos.y + self.elem.rect.y)
-            this_dis = pygame.Vector2(block_pos).distance_squared_to(vpos)
-            if closest_dis is None or this_dis < closest_dis:
-                closest = [i]
-                closest_dis = this_dis
-            if type(b) is CodeContainer:
-                b: CodeContainer
-                this_cur, this_dis = b.cursor_closest(pos, self.elem.rect, [i])
-                if this_dis < closest_dis:
-                    closest = this_cur
+        closest_n = -1
+        for step, start in ((1, lo), (-1, lo - 1)):
+            n = start
+            while 0 <= n < len(ys):
+                dy = point_y(n) - py
+                if closest_dis is not None and dy * dy > closest_dis:
+                    break
+                dx = xs[n] - px
+                this_dis = dx * dx + dy * dy
+                if closest_dis is None or this_dis < closest_dis or (this_dis == closest_dis and n < closest_n):
                     closest_dis = this_dis
-        if len(self.blocks) > 0:
-            last_b = self.blocks[-1]
-            block_pos = (last_b.pos.x + self.elem.rect.x, last_b.pos.y + self.elem.rect.y + last_b.get_box().h)
-            last_dis = pygame.Vector2(block_pos).distance_squared_to(vpos)
-            if last_dis < closest_dis:
-                closest = [len(self.blocks)]
-                closest_dis = last_dis
+                    closest_n = n
+                n += step
 
+        closest = list(paths[closest_n])
         self.set_cursor(closest)
         return closest, closest_dis
 
     def update(self):
-        current_y = self.scroll
+        if self.label_version != label_version:
+            # Label sizes changed, so every container must be measured again
+            self.label_version = label_version
+            self.dirty = True
+            self.cursor_points = None
+            for b in self.blocks:
+                if type(b) is CodeContainer:
+                    b: CodeContainer
+                    b.invalidate_tree()
+        if not self.dirty:
+            return
+        self.dirty = False
+        current_y = 0
         for i, b in enumerate(self.blocks):
             b: Codeblock
             if i == self.cursors[0]:
@@ -841,30 +1251,35 @@ class Code:
             current_y += b.get_box().h
 
     def draw_cursor(self, screen: pygame.Surface):
-        current_y = self.scroll
-        for i, b in enumerate(self.blocks):
-            b: Codeblock
-            if i == self.cursors[0]:
-                if len(self.cursors) == 1:
-                    fill_rect(screen, pygame.Rect(0, current_y, 1000, cursor_h), 0xFFFFFF1F)
-                    current_y += cursor_h
-                if type(b) is CodeContainer:
-                    b: CodeContainer
-                    b.draw_cursor(screen, self.cursors[1:], (0, current_y))
-            current_y += b.get_box().h
-        if self.cursors is not None and len(self.cursors) > 0 and self.cursors[0] == len(self.blocks):
-            fill_rect(screen, pygame.Rect(0, current_y, 1000, cursor_h), 0xFFFFFF1F)
-            current_y += cursor_h
+        # Follow the cursor path down to its list, using the cached positions
+        context = self.blocks
+        origin = (0, 0)
+        for c in self.cursors[:-1]:
+            if c >= len(context) or type(context[c]) is not CodeContainer:
+                return
+            origin = context[c].get_origin()
+            context = context[c].children
+        index = self.cursors[-1]
+        if index < len(context):
+            y = context[index].pos.y - cursor_h
+        elif len(context) > 0:
+            y = context[-1].pos.y + context[-1].get_box().h
+        else:
+            y = origin[1]
+        fill_rect(screen, pygame.Rect(origin[0], y + self.scroll, 1000, cursor_h), 0xFFFFFF1F)
 
     def set_cursor(self, path: list):
-        self.cursors = path
+        if path != self.cursors:
+            self.invalidate_path(self.cursors)
+            self.invalidate_path(path)
+            self.cursors = path
         self.update()
 
     def render(self, screen: pygame.Surface):
         dest = screen.subsurface(self.elem.rect)
-        for i, b in enumerate(self.blocks):
-            b: Codeblock
-            b.draw(dest)
+        blits = []
+        collect_visible(dest.get_clip(), self.blocks, (0, self.scroll), blits)
+        dest.blits(blits, False)
         self.draw_cursor(dest)
 
     def exec(self):
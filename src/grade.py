@@ -0,0 +1,152 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import programs
+import simulation
+
+# Grades student programs outside of the game. Reads JSON lines such as
+#   {"id": "alice", "level": "level3", "program": "f4(lf)r"}
+# with programs in the format of programs.py, and writes one JSON line of
+# results per record, in the order they complete. Equivalent programs are
+# only simulated once (see simulation.run_cached).
+
+level_dir = "src/res/levels"
+batch_size = 256
+max_steps = 100000
+
+_levels = dict()
+_cache = simulation.results
+
+
+def configure(levels: str, steps: int, cache_path: str = None):
+    global level_dir, max_steps, _cache
+    level_dir = levels
+    max_steps = steps
+    _levels.clear()
+    if cache_path is not None:
+        _cache = simulation.ResultCache(path=cache_path)
+
+
+def get_level(name: str) -> simulation.Level:
+    level = _levels.get(name)
+    if level is None:
+        if os.path.basename(name) != name:
+            raise ValueError(f"Invalid level name: {name}")
+        level = simulation.Level(os.path.join(level_dir, name + ".yaml"))
+        _levels[name] = level
+    return level
+
+
+def grade(record: dict) -> dict:
+    result = {"id": record.get("id"), "level": record.get("level")}
+    try:
+        level = get_level(str(record["level"]))
+        program = programs.decode(record["program"])
+    except (KeyError, TypeError, ValueError, OSError) as err:
+        result["result"] = "error"
+        result["error"] = str(err)
+        return result
+    robot = simulation.run_cached(level, program, max_steps, _cache)
+    if robot.state == 1:
+        result["result"] = "win"
+    elif robot.state == 2:
+        result["result"] = "lose"
+    elif robot.state == 3:
+        result["result"] = "timeout"
+    else:
+        result["result"] = "incomplete"
+    result["steps"] = robot.steps
+    result["coins"] = robot.coin_counter
+    result["stars"] = simulation.get_stars(level, robot, simulation.count_blocks(program))
+    return result
+
+
+def grade_batch(lines: list) -> list:
+    # Runs in a worker process, which keeps its own level cache
+    results = []
+    for number, line in lines:
+        try:
+            record = json.loads(line)
+            if type(record) is not dict:
+                raise ValueError("Record is not an object.")
+        except ValueError as err:
+            results.append({"line": number, "result": "error", "error": str(err)})
+            continue
+        try:
+            results.append(grade(record))
+        except Exception as err:
+            # A record that breaks the simulation only fails itself, not
+            # the rest of its batch
+            result = {"line": number, "id": record.get("id"), "level": record.get("level")}
+            result["result"] = "error"
+            result["error"] = f"{type(err).__name__}: {err}"
+            results.append(result)
+    _cache.flush()
+    return results
+
+
+def read_batches(file) -> iter:
+    batch = []
+    for number, line in enumerate(file, 1):
+        if line.strip() == "":
+            continue
+        batch.append((number, line))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def write_results(out, results: list):
+    for result in results:
+        out.write(json.dumps(result) + "\n")
+    out.flush()
+
+
+def grade_stream(src, out, workers: int, cache_path: str = None):
+    if workers <= 1:
+        for batch in read_batches(src):
+            write_results(out, grade_batch(batch))
+        return
+    # Only a few batches per worker are read ahead, so memory use doesn't
+    # grow with the size of the input
+    initargs = (level_dir, max_steps, cache_path)
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=configure, initargs=initargs) as pool:
+        pending = set()
+        for batch in read_batches(src):
+            if len(pending) >= workers * 2:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    write_results(out, future.result())
+            pending.add(pool.submit(grade_batch, batch))
+        for future in concurrent.futures.as_completed(pending):
+            write_results(out, future.result())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Grade block programs against the game levels.")
+    parser.add_argument("input", nargs="?", default="-", help="JSON lines file of records, - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="JSON lines file for results, - for stdout")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--levels", default=level_dir, help="directory of level files")
+    parser.add_argument("--max-steps", type=int, default=max_steps, help="moves before a run times out")
+    parser.add_argument("--cache", help="SQLite file keeping results between runs")
+    args = parser.parse_args()
+    configure(args.levels, args.max_steps, args.cache)
+
+    src = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        grade_stream(src, out, args.jobs, args.cache)
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
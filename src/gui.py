@@ -1,15 +1,63 @@
 import html.parser
+import json
+import os
+from collections import OrderedDict
 import pygame
 from pygame.image import load_extended
+import inputs
 import languages
+import ticks
 
 _font: pygame.font.Font
+# Incremented whenever the font changes, so documents know to relayout
+font_version = 0
 scroll_speed = 50
+# Time (ms) for a wheel scroll to cover half of its remaining distance
+scroll_half_life = 40
+# Rows laid out above and below the visible part of a virtual list
+list_overscan = 2
+# Compiled page templates are stored here, next to the pages they come from
+template_dir = "src/res/.cache"
+template_version = 1
+_templates = dict()
+# Decoded images by path, and their resized copies by (path, size, smooth)
+scaled_cache_size = 128
+_images = dict()
+_scaled = OrderedDict()
+# Cell size (in pixels) of the grid used to find elements under the mouse
+hit_cell = 64
+# Window sizes whose layout each document keeps, to switch back for free
+layout_cache_size = 4
 
 
 def init(font, size):
-    global _font
+    global _font, font_version
     _font = pygame.font.Font(font, size)
+    font_version += 1
+
+
+def get_image(path: str) -> pygame.Surface:
+    image = _images.get(path)
+    if image is None:
+        image = load_extended(path)
+        _images[path] = image
+    return image
+
+
+def get_scaled(path: str, size: tuple, smooth: bool) -> pygame.Surface:
+    key = (path, size, smooth)
+    image = _scaled.get(key)
+    if image is not None:
+        _scaled.move_to_end(key)
+        return image
+    if smooth:
+        image = pygame.transform.smoothscale(get_image(path), size)
+    else:
+        image = pygame.transform.scale(get_image(path), size)
+    _scaled[key] = image
+    while len(_scaled) > scaled_cache_size:
+        _scaled.popitem(last=False)
+    return image
 
 
 def debug(func: callable) -> callable:
@@ -22,16 +70,39 @@ def debug(func: callable) -> callable:
     return wrapper
 
 
+def incremental(func: callable) -> callable:
+    # Skip layout of clean subtrees that are given the same area as last time
+    def wrapper(self: "Element", rect: pygame.Rect, document: "DocumentXML", max_rect: pygame.Rect):
+        key = (tuple(rect), tuple(max_rect))
+        if not self.dirty and self.layout_key == key:
+            return
+        self.layout_key = key
+        self.dirty = False
+        document.layout_serial += 1
+        return func(self, rect, document, max_rect)
+
+    return wrapper
+
+
+def measured(func: callable) -> callable:
+    # Cache minimum sizes until the element is invalidated
+    def wrapper(self: "Element") -> pygame.Rect:
+        if self.min_rect is None:
+            self.min_rect = func(self)
+        return self.min_rect.copy()
+
+    return wrapper
+
+
 def draw_margin(func: callable) -> callable:
     def wrapper(self: "Element", rect: pygame.Rect, document: "DocumentXML", max_rect: pygame.Rect):
-        if self.margin.endswith("px"):
-            margin = float(self.margin[:-2])
+        margin = self.margin.value
+        if self.margin.unit == "px":
             rect.x += margin
             rect.y += margin
             rect.w -= margin * 2
             rect.h -= margin * 2
-        elif self.margin.endswith("%"):
-            margin = float(self.margin[:-1]) / 100.
+        elif self.margin.unit == "%":
             rect.x += margin * rect.w
             rect.y += margin * rect.h
             rect.w -= margin * rect.w * 2
@@ -44,14 +115,13 @@ def draw_margin(func: callable) -> callable:
 def add_margin(func: callable) -> callable:
     def wrapper(self: "Element"):
         rect = func(self)
-        if self.margin.endswith("px"):
-            margin = float(self.margin[:-2])
+        margin = self.margin.value
+        if self.margin.unit == "px":
             rect.x -= margin
             rect.y -= margin
             rect.w += margin * 2
             rect.h += margin * 2
-        elif self.margin.endswith("%"):
-            margin = float(self.margin[:-1]) / 100.
+        elif self.margin.unit == "%":
             rect.x -= margin * rect.w
             rect.y -= margin * rect.h
             rect.w += margin * rect.w * 2
@@ -81,11 +151,59 @@ def draw_text(screen: pygame.Surface, rect: pygame.Rect, data: str, colour):
     screen.blit(font_surface, (rect.x + 10, rect.y + 10))
 
 
+class Length:
+    # Pre-parsed length/margin value. Percentages are stored as fractions.
+    __slots__ = ("unit", "value")
+
+    def __init__(self, unit: str, value: float = 0.):
+        self.unit = unit
+        self.value = value
+
+    @staticmethod
+    def parse(text: str, units: tuple = ("px", "%", "auto", "min")) -> "Length":
+        text = text.strip()
+        if text in ("auto", "min") and text in units:
+            return Length(text)
+        try:
+            if text.endswith("px") and "px" in units:
+                return Length("px", float(text[:-2]))
+            elif text.endswith("%") and "%" in units:
+                return Length("%", float(text[:-1]) / 100.)
+        except ValueError:
+            pass
+        raise ValueError(f"Invalid length '{text}'")
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Length):
+            return NotImplemented
+        return self.unit == other.unit and self.value == other.value
+
+    def __repr__(self) -> str:
+        if self.unit == "%":
+            return f"Length(%, {self.value * 100.})"
+        return f"Length({self.unit}, {self.value})"
+
+
 class Element:
+    __slots__ = (
+        "tag", "children", "data", "parent",
+        "dirty", "restructured", "layout_key", "min_rect",
+        "rect", "attrs", "bounding_box", "length", "margin",
+        "id", "on_click", "scrollable", "colour",
+        "cached", "cache_surface", "cache_key",
+    )
+
     def __init__(self, document: "DocumentXML", tag: str, attrs: dict):
         self.tag = tag
         self.children = []
         self.data = ""
+        self.parent = None
+
+        # Layout state
+        self.dirty = True
+        self.restructured = True
+        self.layout_key = None
+        self.min_rect = None
 
         self.rect: pygame.Rect
         self.rect = None
@@ -94,14 +212,14 @@ class Element:
         self.bounding_box = None
 
         if "length" in attrs:
-            self.length = attrs["length"]
+            self.length = Length.parse(attrs["length"])
         else:
-            self.length = "auto"
+            self.length = Length("auto")
 
         if "margin" in attrs:
-            self.margin = attrs["margin"]
+            self.margin = Length.parse(attrs["margin"], ("px", "%"))
         else:
-            self.margin = "0px"
+            self.margin = Length("px")
 
         if "id" in attrs:
             self.id = attrs["id"]
@@ -120,6 +238,12 @@ class Element:
         else:
             self.scrollable = False
 
+        # Cached elements keep a copy of their rendered subtree, which is
+        # blitted back until layout, hover, font or language change
+        self.cached = "cached" in attrs
+        self.cache_surface = None
+        self.cache_key = None
+
         if "color" in self.attrs:
             v = self.attrs["color"]
             if v.startswith("#"):
@@ -136,15 +260,69 @@ class Element:
             self.colour = 0x00000000
 
     def add_child(self, elem):
+        elem.parent = self
         self.children.append(elem)
+        self.invalidate(True)
+
+    def clear_children(self):
+        for c in self.children:
+            c.parent = None
+        self.children.clear()
+        self.invalidate(True)
+
+    def invalidate(self, restructured: bool = False):
+        # Flag this element for relayout, along with the ancestors whose
+        # sizes may depend on it
+        elem = self
+        while elem is not None:
+            if elem.dirty and elem.min_rect is None and (elem.restructured or not restructured):
+                break
+            elem.dirty = True
+            elem.min_rect = None
+            elem.restructured = elem.restructured or restructured
+            elem = elem.parent
+
+    def invalidate_tree(self):
+        self.dirty = True
+        self.min_rect = None
+        for c in self.children:
+            c.invalidate_tree()
+
+    def measure(self):
+        # Measure pass: settle minimum sizes bottom-up, once per element
+        if self.min_rect is None:
+            for c in self.children:
+                c.measure()
+            self.get_min()
+
+    def child_clip(self) -> pygame.Rect:
+        # Area that children of this element are drawn within
+        return self.rect.clip(self.bounding_box)
+
+    def translate(self, dx: int, dy: int, max_rect: pygame.Rect):
+        # Move an arranged subtree without laying it out again
+        self.rect = self.rect.move(dx, dy)
+        self.bounding_box = max_rect
+        if self.layout_key is not None:
+            x, y, w, h = self.layout_key[0]
+            self.layout_key = ((x + dx, y + dy, w, h), tuple(max_rect))
+        clip = self.child_clip()
+        for c in self.children:
+            c.translate(dx, dy, clip)
+
+    def save_layout(self) -> tuple:
+        return self.rect.copy(), self.bounding_box.copy(), self.layout_key
+
+    def load_layout(self, state: tuple):
+        self.rect, self.bounding_box, self.layout_key = state
 
     def reset(self):
         pass
 
     # Overridable
+    @incremental
     @draw_margin
     def calc_draw(self, rect: pygame.Rect, document: "DocumentXML", max_rect: pygame.Rect):
-        document.add_drawable(self)
         self.rect = rect
         self.bounding_box = max_rect
 
@@ -153,6 +331,7 @@ class Element:
         pass
 
     # Overridable
+    @measured
     @add_margin
     def get_min(self) -> pygame.Rect:
         return pygame.Rect(0, 0, 0., 0.)
@@ -180,6 +359,8 @@ class Element:
 
 
 class Container(Element):
+    __slots__ = ("scroll", "align")
+
     def __init__(self, document: "DocumentXML", tag: str, attrs: dict):
         super().__init__(document, tag, attrs)
 
@@ -238,22 +419,21 @@ class Container(Element):
         auto_sized = []
         available_size = along
         for i, c in enumerate(self.children):
-            if c.length == "auto":
+            unit = c.length.unit
+            if unit == "auto":
                 auto_sized.append((i, c))
-            elif c.length.endswith("%"):
-                size = float(c.length[:-1]) / 100.
-                lengths[i] = along * size
-                available_size -= along * size
-            elif c.length.endswith("px"):
-                size = float(c.length[:-2])
+            elif unit == "%":
+                size = along * c.length.value
+                lengths[i] = size
+                available_size -= size
+            elif unit == "px":
+                size = c.length.value
                 lengths[i] = size
                 available_size -= size
-            elif c.length == "min":
+            elif unit == "min":
                 size = rect2along(c.get_min())[2]
                 lengths[i] = size
                 available_size -= size
-            else:
-                raise ValueError(c.attrs["len"])
         if len(auto_sized) == 0:
             return self.distribute(lengths, available_size, rect2along(rect))
         elif self.align == "proportional":
@@ -262,32 +442,33 @@ class Container(Element):
                 min_size = rect2along(c.get_min())[2]
                 lengths[i] = min_size
                 min_sum += min_size
-            if min_sum <= available_size:
+            if min_sum == 0 and available_size > 0:
+                # Nothing to be proportional to, so split evenly
+                for i, c in auto_sized:
+                    lengths[i] = available_size / len(auto_sized)
+            elif min_sum <= available_size:
                 for t in auto_sized:
                     i, c = t
                     lengths[i] = lengths[i] * available_size / min_sum
             return self.distribute(lengths, 0, rect2along(rect))
         else:
-            divided = 0
-            while len(auto_sized) > 0:
-                fixed_size = []
-                estimate = available_size / len(auto_sized)
-                for t in auto_sized:
-                    i, c = t
-                    min_size = rect2along(c.get_min())[2]
-                    if min_size > estimate:
-                        fixed_size.append(t)
-                        available_size -= min_size
-                        lengths[i] = min_size
-                if len(fixed_size) == 0:
-                    divided = available_size / len(auto_sized)
+            # Split the space evenly, except for children whose minimum size
+            # is larger than their share, which are settled largest first
+            by_size = sorted(
+                ((rect2along(c.get_min())[2], i) for i, c in auto_sized),
+                reverse=True
+            )
+            remaining = len(by_size)
+            for min_size, i in by_size:
+                if min_size <= available_size / remaining:
                     break
-                for i in fixed_size:
-                    if i in auto_sized:
-                        auto_sized.remove(i)
-            for i, c in auto_sized:
+                lengths[i] = min_size
+                available_size -= min_size
+                remaining -= 1
+            divided = available_size / remaining if remaining > 0 else 0
+            for _, i in by_size[len(by_size) - remaining:]:
                 lengths[i] = divided
-                available_size -= lengths[i]
+                available_size -= divided
             return self.distribute(lengths, available_size, rect2along(rect))
 
     def calc_min(self, rect2along: callable) -> tuple:
@@ -296,27 +477,53 @@ class Container(Element):
         along_percent = 1
         for c in self.children:
             start_along, start_across, this_along, this_across = rect2along(c.get_min())
-            if c.length == "auto":
-                along += this_along
-            elif c.length.endswith("%"):
-                along_percent -= float(c.length[:-1]) / 100.
-            elif c.length.endswith("px"):
-                along += float(c.length[:-2])
-            elif c.length == "min":
+            unit = c.length.unit
+            if unit == "auto" or unit == "min":
                 along += this_along
+            elif unit == "%":
+                along_percent -= c.length.value
+            elif unit == "px":
+                along += c.length.value
             across = max(across, this_across)
         if along_percent > 0:
             along /= along_percent
         return 0, 0, along, across
 
+    def scroll_axis(self) -> tuple:
+        return 0, 1
+
+    def scroll_by(self, delta: int, document: "DocumentXML") -> int:
+        # Scrolling only shifts the arranged children along the main axis,
+        # as long as the current layout is up to date
+        self.scroll += delta
+        if self.dirty or self.layout_key is None:
+            self.invalidate()
+            return delta
+        ax, ay = self.scroll_axis()
+        clip = self.child_clip()
+        for c in self.children:
+            c.translate(ax * delta, ay * delta, clip)
+        return delta
+
+    def save_layout(self) -> tuple:
+        return super().save_layout() + (self.scroll,)
+
+    def load_layout(self, state: tuple):
+        super().load_layout(state[:-1])
+        self.scroll = state[-1]
+
     def reset(self):
-        self.scroll = 0
+        if self.scroll != 0:
+            self.scroll = 0
+            self.invalidate()
         for c in self.children:
             if isinstance(c, Container):
                 c.reset()
 
 
 class Space(Element):
+    __slots__ = ()
+
     def __init__(self, document: "DocumentXML", tag: str, attrs: dict):
         super().__init__(document, tag, attrs)
 
@@ -336,6 +543,8 @@ class Space(Element):
 
 
 class Image(Element):
+    __slots__ = ("image", "image_scaled", "hover_colour", "align", "smooth")
+
     def __init__(self, document: "DocumentXML", tag: str, attrs: dict):
         super().__init__(document, tag, attrs)
         self.image = None
@@ -358,12 +567,25 @@ class Image(Element):
         else:
             self.smooth = False
 
+    def save_layout(self) -> tuple:
+        return super().save_layout() + (self.image_scaled,)
+
+    def load_layout(self, state: tuple):
+        super().load_layout(state[:-1])
+        self.image_scaled = state[-1]
+
+    def set_data(self, data: str):
+        if data != self.data:
+            self.data = data
+            self.image = None
+            self.invalidate()
+
+    @incremental
     @draw_margin
     def calc_draw(self, rect: pygame.Rect, document: "DocumentXML", max_rect: pygame.Rect):
-        document.add_drawable(self)
         self.bounding_box = max_rect
         if not self.image:
-            self.image = load_extended(str(self.data))
+            self.image = get_image(str(self.data))
         img_width, img_height = self.image.get_size()
         if rect.w / rect.h > img_width / img_height:
             w = img_width * rect.h / img_height
@@ -381,10 +603,7 @@ class Image(Element):
                 r = pygame.Rect(rect.x, rect.y + rect.h - h, rect.w, h)
             else:
                 r = pygame.Rect(rect.x, rect.y + (rect.h - h) / 2, rect.w, h)
-        if self.smooth:
-            self.image_scaled = pygame.transform.smoothscale(self.image, (r.w, r.h))
-        else:
-            self.image_scaled = pygame.transform.scale(self.image, (r.w, r.h))
+        self.image_scaled = get_scaled(str(self.data), r.size, self.smooth)
         self.rect = r
 
     def draw(self, screen: pygame.Surface, document: "DocumentXML"):
@@ -407,6 +626,8 @@ class Image(Element):
 
 
 class Button(Element):
+    __slots__ = ("align",)
+
     def __init__(self, document: "DocumentXML", tag: str, attrs: dict):
         super().__init__(document, tag, attrs)
 
@@ -447,6 +668,7 @@ class Button(Element):
             r = pygame.Rect(rect.x + gap_x / 2, rect.y + gap_y / 2, 0, 0)
             draw_text(dest, r, languages.get_str(self.data), 0xFFFFFFFF)
 
+    @measured
     @add_margin
     def get_min(self) -> pygame.Rect:
         font_size = _font.size(languages.get_str(self.data))
@@ -454,6 +676,8 @@ class Button(Element):
 
 
 class Text(Element):
+    __slots__ = ()
+
     def draw(self, screen: pygame.Surface, document: "DocumentXML"):
         if self.bounding_box.size == (0, 0):
             return
@@ -466,6 +690,7 @@ class Text(Element):
         draw_box(dest, rect, 0xFF00FF, True)
         draw_text(dest, rect, languages.get_str(self.data), self.colour)
 
+    @measured
     @add_margin
     def get_min(self) -> pygame.Rect:
         font_size = _font.size(languages.get_str(self.data))
@@ -473,6 +698,8 @@ class Text(Element):
 
 
 class Horizontal(Container):
+    __slots__ = ()
+
     def __init__(self, document: "DocumentXML", tag: str, attrs: dict):
         super().__init__(document, tag, attrs)
         # Generalise horizontal-specific values to container-compatible ones
@@ -481,9 +708,12 @@ class Horizontal(Container):
         if self.align == "right":
             self.align = "after"
 
+    def scroll_axis(self) -> tuple:
+        return 1, 0
+
+    @incremental
     @draw_margin
     def calc_draw(self, rect: pygame.Rect, document: "DocumentXML", max_rect: pygame.Rect):
-        document.add_drawable(self)
         self.bounding_box = max_rect
         self.rect = rect
         items = self.repart(rect, lambda r: (r.x, r.y, r.w, r.h))
@@ -503,6 +733,7 @@ class Horizontal(Container):
             fill_rect(dest, rect, self.colour)
         draw_box(dest, rect, 0xFF0000)
 
+    @measured
     @add_margin
     def get_min(self) -> pygame.Rect:
         along_t = self.calc_min(lambda r: (r.x, r.y, r.w, r.h))
@@ -510,6 +741,8 @@ class Horizontal(Container):
 
 
 class Vertical(Container):
+    __slots__ = ()
+
     def __init__(self, document: "DocumentXML", tag: str, attrs: dict):
         super().__init__(document, tag, attrs)
         # Generalise vertical-specific values to container-compatible ones
@@ -518,9 +751,9 @@ class Vertical(Container):
         if self.align == "down":
             self.align = "after"
 
+    @incremental
     @draw_margin
     def calc_draw(self, rect: pygame.Rect, document: "DocumentXML", max_rect: pygame.Rect):
-        document.add_drawable(self)
         self.bounding_box = max_rect
         self.rect = rect
         items = self.repart(rect, lambda r: (r.y, r.x, r.h, r.w))
@@ -540,19 +773,147 @@ class Vertical(Container):
             fill_rect(dest, rect, self.colour)
         draw_box(dest, rect, 0x00FF00)
 
+    @measured
     @add_margin
     def get_min(self) -> pygame.Rect:
         along_t = self.calc_min(lambda r: (r.y, r.x, r.h, r.w))
         return pygame.Rect(0, 0, along_t[3], along_t[2])
 
 
+class VirtualList(Vertical):
+    # Vertical list of equally tall rows, of which only the ones in view
+    # (plus list_overscan) exist as children. Rows come from a callback,
+    # build(index, recycled) -> Element, which may reuse an old row.
+    __slots__ = ("row_count", "build", "row_w", "row_h", "first", "pool")
+
+    def __init__(self, document: "DocumentXML", tag: str, attrs: dict):
+        super().__init__(document, tag, attrs)
+        self.row_count = 0
+        self.build = None
+        self.row_w = 0
+        self.row_h = None
+        self.first = 0
+        self.pool = []
+
+    def set_rows(self, count: int, build: callable):
+        self.clear_children()
+        self.row_count = count
+        self.build = build
+        self.row_w = 0
+        self.row_h = None
+        self.first = 0
+        self.pool = []
+        self.scroll = 0
+
+    def invalidate_tree(self):
+        # Text sizes changed, so rows must be measured again
+        super().invalidate_tree()
+        self.row_h = None
+        self.pool = []
+
+    def get_row(self, index: int, old: dict) -> Element:
+        row = old.pop(index, None)
+        if row is None:
+            recycled = self.pool.pop() if self.pool else None
+            row = self.build(index, recycled)
+            row.invalidate_tree()
+        row.parent = self
+        return row
+
+    def measure_rows(self):
+        # Rows share one height, but their labels differ in width, so every
+        # row is measured, rebuilding the same spare row for each index
+        if self.row_h is None and self.row_count > 0:
+            row = self.pool.pop() if self.pool else None
+            self.row_w = 0
+            self.row_h = 1
+            for i in range(self.row_count):
+                row = self.build(i, row)
+                row.parent = self
+                row.invalidate_tree()
+                size = row.get_min()
+                self.row_w = max(self.row_w, size.w)
+                self.row_h = max(self.row_h, size.h)
+            row.parent = None
+            self.pool.append(row)
+
+    def update_window(self, height: int):
+        self.measure_rows()
+        if self.row_h is None:
+            return
+        self.scroll = min(max(self.scroll, height - self.row_count * self.row_h), 0)
+        first = max(int(-self.scroll // self.row_h) - list_overscan, 0)
+        last = min(int((height - self.scroll) // self.row_h) + 1 + list_overscan, self.row_count)
+        if first == self.first and len(self.children) == last - first:
+            return
+        old = {self.first + i: c for i, c in enumerate(self.children)}
+        self.children = [self.get_row(i, old) for i in range(first, last)]
+        self.first = first
+        for row in old.values():
+            row.parent = None
+            self.pool.append(row)
+        del self.pool[:-(list_overscan * 2 + 1)]
+        # New rows need to be drawn, but nothing above has to be measured again
+        elem = self
+        while elem is not None and not elem.restructured:
+            elem.restructured = True
+            elem = elem.parent
+
+    @incremental
+    @draw_margin
+    def calc_draw(self, rect: pygame.Rect, document: "DocumentXML", max_rect: pygame.Rect):
+        self.bounding_box = max_rect
+        self.rect = rect
+        self.update_window(rect.h)
+        clip = rect.clip(max_rect)
+        for i, c in enumerate(self.children):
+            y = rect.y + self.scroll + (self.first + i) * self.row_h
+            c.calc_draw(pygame.Rect(rect.x, y, rect.w, self.row_h), document, clip)
+
+    def save_layout(self) -> tuple:
+        return super().save_layout() + (self.first,)
+
+    def load_layout(self, state: tuple):
+        super().load_layout(state[:-1])
+        self.first = state[-1]
+
+    def scroll_by(self, delta: int, document: "DocumentXML") -> int:
+        old = self.scroll
+        self.scroll += delta
+        if self.dirty or self.layout_key is None:
+            self.invalidate()
+            return delta
+        self.update_window(self.rect.h)
+        # Rows that stay in view are shifted, only new ones are laid out
+        clip = self.child_clip()
+        for i, c in enumerate(self.children):
+            y = self.rect.y + self.scroll + (self.first + i) * self.row_h
+            if c.dirty or c.layout_key is None:
+                c.calc_draw(pygame.Rect(self.rect.x, y, self.rect.w, self.row_h), document, clip)
+            else:
+                c.translate(0, y - c.layout_key[0][1], clip)
+        return self.scroll - old
+
+    @measured
+    @add_margin
+    def get_min(self) -> pygame.Rect:
+        # The list scrolls, so only the width of its rows is required
+        self.measure_rows()
+        return pygame.Rect(0, 0, self.row_w, 0)
+
+
 class Lengthwise(Container):
+    __slots__ = ()
+
     def __init__(self, document: "DocumentXML", tag: str, attrs: dict):
         super().__init__(document, tag, attrs)
 
+    def scroll_axis(self) -> tuple:
+        return (1, 0) if self.rect.w > self.rect.h else (0, 1)
+
+    @incremental
     @draw_margin
     def calc_draw(self, rect: pygame.Rect, document: "DocumentXML", max_rect: pygame.Rect):
-        document.add_drawable(self)
         self.bounding_box = max_rect
         self.rect = rect
         if rect.w > rect.h:
@@ -577,20 +938,26 @@ class Lengthwise(Container):
             fill_rect(dest, rect, self.colour)
         draw_box(dest, rect, 0x00FF00)
 
+    @measured
     @add_margin
     def get_min(self) -> pygame.Rect:
         along_t = self.calc_min(lambda r: (r.x, r.y, r.w, r.h))
         greater = max(along_t[3], along_t[2])
-        return pygame.Rect(0, 0, greater)
+        return pygame.Rect(0, 0, greater, greater)
 
 
 class Crosswise(Container):
+    __slots__ = ()
+
     def __init__(self, document: "DocumentXML", tag: str, attrs: dict):
         super().__init__(document, tag, attrs)
 
+    def scroll_axis(self) -> tuple:
+        return (0, 1) if self.rect.w > self.rect.h else (1, 0)
+
+    @incremental
     @draw_margin
     def calc_draw(self, rect: pygame.Rect, document: "DocumentXML", max_rect: pygame.Rect):
-        document.add_drawable(self)
         self.bounding_box = max_rect
         self.rect = rect
         if rect.w > rect.h:
@@ -615,17 +982,23 @@ class Crosswise(Container):
             fill_rect(dest, rect, self.colour)
         draw_box(dest, rect, 0x00FF00)
 
+    @measured
     @add_margin
     def get_min(self) -> pygame.Rect:
         along_t = self.calc_min(lambda r: (r.y, r.x, r.h, r.w))
         greater = max(along_t[3], along_t[2])
-        return pygame.Rect(0, 0, greater)
+        return pygame.Rect(0, 0, greater, greater)
 
 
 class Overlap(Element):
+    __slots__ = ()
+
+    def child_clip(self) -> pygame.Rect:
+        return self.rect
+
+    @incremental
     @draw_margin
     def calc_draw(self, rect: pygame.Rect, document: "DocumentXML", max_rect: pygame.Rect):
-        document.add_drawable(self)
         self.bounding_box = max_rect
         self.rect = rect
         for c in self.children:
@@ -642,6 +1015,7 @@ class Overlap(Element):
         )
         draw_box(dest, rect, 0xFFFF00)
 
+    @measured
     @add_margin
     def get_min(self) -> pygame.Rect:
         w, h = 0, 0
@@ -659,8 +1033,27 @@ class DocumentXML:
         self.on_click = list()
         self.on_hover = list()
         self.drawables = list()
+        # Index of each drawable, and index past the end of its subtree
+        self.draw_index = dict()
+        self.subtree_end = list()
         self.callbacks = None
         self.hover_element = None
+        # Font and language the current layout was computed with
+        self.layout_env = None
+        self.layout_serial = 0
+        self.area = None
+        self.resize_pending = False
+        # Saved layouts by area, (epoch, [(element, state), ...]). The epoch
+        # changes whenever content or structure changes, which voids them.
+        self.layouts = OrderedDict()
+        self.epoch = 0
+        # Scroll distance still to be covered, by element
+        self.scrolling = dict()
+        # Grid of drawable indices, (cell x, cell y) -> [index, ...]
+        self.hit_grid = dict()
+        self.hit_serial = -1
+        # Last trace_element query, reused while the mouse stays still
+        self.trace_cache = (None, -1, None)
 
     def set_callbacks(self, callbacks: dict):
         self.callbacks = callbacks
@@ -672,46 +1065,168 @@ class DocumentXML:
         self.callbacks[elem.on_click](elem)
 
     def add_drawable(self, elem: Element):
+        i = len(self.drawables)
         self.drawables.append(elem)
+        self.subtree_end.append(i + 1)
+        self.draw_index[elem] = i
+        elem.restructured = False
+        for c in elem.children:
+            self.add_drawable(c)
+        self.subtree_end[i] = len(self.drawables)
 
     def calc_draw(self, rect: pygame.Rect):
         self.root: Element
-        self.drawables.clear()
+        env = (font_version, languages.version)
+        if self.layout_env != env:
+            # Text sizes may have changed anywhere in the tree
+            self.layout_env = env
+            self.root.invalidate_tree()
+        self.resize_pending = False
+        if self.root.dirty:
+            self.epoch += 1
+        serial = self.layout_serial
+        key = tuple(rect)
+        saved = self.layouts.get(key)
+        if saved is not None and saved[0] == self.epoch and self.area != rect:
+            for elem, state in saved[1]:
+                elem.load_layout(state)
+            self.layouts.move_to_end(key)
+            self.area = rect
+            self.layout_serial += 1
+            self.refresh(serial)
+            return
+        self.root.measure()
+        self.area = rect
         self.root.calc_draw(rect, self, rect)
+        self.refresh(serial)
+        if self.layout_serial != serial:
+            self.layouts[key] = (self.epoch, [(d, d.save_layout()) for d in self.drawables])
+            self.layouts.move_to_end(key)
+            while len(self.layouts) > layout_cache_size:
+                self.layouts.popitem(last=False)
+
+    def refresh(self, serial: int):
+        # Bring drawables and the hit grid up to date after a layout change
+        if self.root.restructured:
+            self.drawables.clear()
+            self.draw_index.clear()
+            self.subtree_end.clear()
+            self.add_drawable(self.root)
+            self.layout_serial += 1
+            self.epoch += 1
+        if self.layout_serial != serial or self.hit_serial < 0:
+            self.build_hit_grid(self.area)
+
+    def scroll(self, elem: Container, delta: int):
+        self.scrolling[elem] = self.scrolling.get(elem, 0) + delta
+
+    def update(self, screen: pygame.Surface):
+        # Window resizes are applied once per frame, with the latest size
+        if self.resize_pending:
+            self.calc_draw(screen.get_clip())
+        # Ease scrolling elements towards their target offset
+        if not self.scrolling or self.area is None:
+            return
+        self.epoch += 1
+        serial = self.layout_serial
+        ease = 1 - 0.5 ** (max(ticks.get_variation(), 0) / scroll_half_life)
+        for elem, remaining in list(self.scrolling.items()):
+            step = int(remaining * ease)
+            if step == 0:
+                step = remaining if abs(remaining) < 2 else (1 if remaining > 0 else -1)
+            moved = elem.scroll_by(step, self)
+            remaining -= step
+            if remaining == 0 or moved != step:
+                del self.scrolling[elem]
+            else:
+                self.scrolling[elem] = remaining
+        if self.root.dirty:
+            self.calc_draw(self.area)
+        else:
+            self.layout_serial += 1
+            self.refresh(serial)
+
+    def build_hit_grid(self, area: pygame.Rect):
+        # Only the visible area can be clicked, so off-screen parts of
+        # scrolled elements are left out of the grid
+        self.hit_grid = dict()
+        for i, elem in enumerate(self.drawables):
+            r = elem.rect.clip(area)
+            if r.w <= 0 or r.h <= 0:
+                continue
+            for y in range(r.top // hit_cell, (r.bottom - 1) // hit_cell + 1):
+                for x in range(r.left // hit_cell, (r.right - 1) // hit_cell + 1):
+                    cell = self.hit_grid.get((x, y))
+                    if cell is None:
+                        self.hit_grid[(x, y)] = [i]
+                    else:
+                        cell.append(i)
+        self.hit_serial = self.layout_serial
 
     def draw(self, screen: pygame.Surface):
-        for d in self.drawables:
-            d: Element
-            d.draw(screen, self)
-
-    def trace_element(self, pos: tuple):
+        self.draw_range(screen, 0, len(self.drawables))
+
+    def draw_range(self, screen: pygame.Surface, start: int, end: int):
+        i = start
+        while i < end:
+            d: Element = self.drawables[i]
+            if d.cached:
+                self.draw_cached(screen, d, i)
+                i = self.subtree_end[i]
+            else:
+                d.draw(screen, self)
+                i += 1
+
+    def draw_cached(self, screen: pygame.Surface, elem: Element, i: int):
+        end = self.subtree_end[i]
+        area = elem.rect.clip(elem.bounding_box).clip(screen.get_clip())
+        hover = None
+        if i <= self.draw_index.get(self.hover_element, -1) < end:
+            hover = self.hover_element
+        key = (self.layout_serial, tuple(area), hover, font_version, languages.version)
+        if elem.cache_key == key:
+            screen.blit(elem.cache_surface, area)
+            return
+        # Render normally, on top of what the ancestors drew, then keep a copy
+        elem.draw(screen, self)
+        self.draw_range(screen, i + 1, end)
+        if area.w > 0 and area.h > 0:
+            elem.cache_surface = screen.subsurface(area).copy()
+            elem.cache_key = key
+
+    def trace_element(self, pos: tuple, scrollable: bool = False):
         # Find element that collides with a certain pos (x, y) (useful for mouse clicks)
-        for elem in reversed(self.drawables):
-            elem: Element
-            if elem.rect.collidepoint(pos):
-                return elem
-        return None
+        pos = tuple(pos)
+        if not scrollable:
+            last_pos, last_serial, last_elem = self.trace_cache
+            if last_pos == pos and last_serial == self.hit_serial:
+                return last_elem
+        found = None
+        for i in reversed(self.hit_grid.get((pos[0] // hit_cell, pos[1] // hit_cell), ())):
+            elem: Element = self.drawables[i]
+            if elem.rect.collidepoint(pos) and (elem.scrollable or not scrollable):
+                found = elem
+                break
+        if not scrollable:
+            self.trace_cache = (pos, self.hit_serial, found)
+        return found
 
     def handle_event(self, screen: pygame.Surface, event: pygame.event.Event):
-        mpos = pygame.mouse.get_pos()
+        mpos = inputs.get_mouse_pos()
         if event.type == pygame.VIDEORESIZE:
-            self.calc_draw(screen.get_clip())
+            self.resize_pending = True
         elif event.type == pygame.MOUSEBUTTONDOWN:
             if event.button == 1:
                 if self.hover_element and self.hover_element.on_click:
                     self.call_event(self.hover_element)
             elif event.button == 4:
-                for elem in reversed(self.drawables):
-                    if elem.rect.collidepoint(mpos) and elem.scrollable:
-                        elem.scroll += scroll_speed
-                        self.calc_draw(screen.get_clip())
-                        break
+                elem = self.trace_element(mpos, True)
+                if elem:
+                    self.scroll(elem, scroll_speed)
             elif event.button == 5:
-                for elem in reversed(self.drawables):
-                    if elem.rect.collidepoint(mpos) and elem.scrollable:
-                        elem.scroll -= scroll_speed
-                        self.calc_draw(screen.get_clip())
-                        break
+                elem = self.trace_element(mpos, True)
+                if elem:
+                    self.scroll(elem, -scroll_speed)
 
 
 class LoaderXML(html.parser.HTMLParser):
@@ -745,10 +1260,10 @@ class LoaderXML(html.parser.HTMLParser):
                 new_tag = None
 
                 if args.tag in LoaderXML.tags:
-                    new_tag = LoaderXML.tags[args.tag](self.document, args.tag, args.attrs)
+                    new_tag = self.create(LoaderXML.tags[args.tag], args)
                     yield from self.tree_builder(new_tag)
                 elif args.tag in LoaderXML.elements:
-                    new_tag = LoaderXML.elements[args.tag](self.document, args.tag, args.attrs)
+                    new_tag = self.create(LoaderXML.elements[args.tag], args)
                 else:
                     self.error(f"Unrecognised element '{args.tag}'")
 
@@ -771,6 +1286,12 @@ class LoaderXML(html.parser.HTMLParser):
                     self.error(f"Closing tags do not match ({elem.tag} != {args.tag})")
                 return
 
+    def create(self, cls: type, args: "LoaderXML.StartTag") -> Element:
+        try:
+            return cls(self.document, args.tag, args.attrs)
+        except ValueError as err:
+            self.error(f"Invalid attribute in '{args.tag}': {err}")
+
     def error(self, message: str):
         ln, cl = self.getpos()
         txt_line = self.text.split('\n')[ln - 1]
@@ -829,6 +1350,7 @@ class LoaderXML(html.parser.HTMLParser):
     tags: dict = {
         "horizontal": Horizontal,
         "vertical": Vertical,
+        "virtual_list": VirtualList,
         "lengthwise": Lengthwise,
         "crosswise": Crosswise,
         "overlap": Overlap,
@@ -840,3 +1362,78 @@ class LoaderXML(html.parser.HTMLParser):
     elements: dict = {
         "space": Space,
     }
+
+
+class Template:
+    # Compact form of a page: a preorder table of (tag, attrs, data, parent
+    # index) rows, from which any number of documents can be built.
+    def __init__(self, nodes: list, mtime: int = 0):
+        self.nodes = nodes
+        self.mtime = mtime
+
+    @staticmethod
+    def compile(document: DocumentXML, mtime: int = 0) -> "Template":
+        nodes = []
+
+        def walk(elem: Element, parent: int):
+            index = len(nodes)
+            nodes.append((elem.tag, elem.attrs, elem.data, parent))
+            for c in elem.children:
+                walk(c, index)
+
+        walk(document.root, -1)
+        return Template(nodes, mtime)
+
+    @staticmethod
+    def cache_path(filename: str) -> str:
+        name = os.path.normpath(filename).replace(os.sep, "_")
+        return os.path.join(template_dir, name + ".json")
+
+    @staticmethod
+    def load(filename: str) -> "Template":
+        mtime = os.stat(filename).st_mtime_ns
+        path = Template.cache_path(filename)
+        try:
+            with open(path, encoding='utf-8') as file:
+                data = json.load(file)
+            if data["version"] == template_version and data["mtime"] == mtime:
+                return Template([tuple(n) for n in data["nodes"]], mtime)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        template = Template.compile(LoaderXML(filename).get_document(), mtime)
+        try:
+            os.makedirs(template_dir, exist_ok=True)
+            with open(path, "w", encoding='utf-8') as file:
+                json.dump({
+                    "version": template_version,
+                    "mtime": mtime,
+                    "nodes": template.nodes,
+                }, file, separators=(",", ":"))
+        except OSError:
+            # Read-only installs just compile pages on every start
+            pass
+        return template
+
+    def instantiate(self) -> DocumentXML:
+        document = DocumentXML()
+        elems = []
+        for tag, attrs, data, parent in self.nodes:
+            if tag in LoaderXML.tags:
+                elem = LoaderXML.tags[tag](document, tag, dict(attrs))
+            else:
+                elem = LoaderXML.elements[tag](document, tag, dict(attrs))
+            elem.data = data
+            elems.append(elem)
+            if parent < 0:
+                document.set_root(elem)
+            else:
+                elems[parent].add_child(elem)
+        return document
+
+
+def load_page(filename: str) -> DocumentXML:
+    template = _templates.get(filename)
+    if template is None or template.mtime != os.stat(filename).st_mtime_ns:
+        template = Template.load(filename)
+        _templates[filename] = template
+    return template.instantiate()
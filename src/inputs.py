@@ -0,0 +1,68 @@
+import gzip
+import json
+import pygame
+import ticks
+
+# Input for the current frame. The game reads the mouse through here, so
+# a recorded session can be fed back in place of the real devices.
+mouse_pos = (0, 0)
+recorder = None
+
+
+def get_mouse_pos() -> tuple:
+    return mouse_pos
+
+
+def poll() -> list:
+    global mouse_pos
+    events = pygame.event.get()
+    mouse_pos = pygame.mouse.get_pos()
+    if recorder is not None:
+        recorder.write(ticks.get_time_ns(), mouse_pos, events)
+    return events
+
+
+def encode_event(event: pygame.event.Event) -> list:
+    attrs = dict()
+    for k, v in event.dict.items():
+        if type(v) is tuple:
+            attrs[k] = list(v)
+        elif v is None or type(v) in (int, float, str, bool):
+            attrs[k] = v
+    return [event.type, attrs]
+
+
+def decode_event(data: list) -> pygame.event.Event:
+    attrs = {k: tuple(v) if type(v) is list else v for k, v in data[1].items()}
+    return pygame.event.Event(data[0], attrs)
+
+
+# Sessions are gzipped JSON lines: a header with the window size and the
+# saved progress the session started from, then one line per frame with
+# its clock time in nanoseconds, the mouse position and the events.
+class Recorder:
+    def __init__(self, filename: str, header: dict):
+        self.file = gzip.open(filename, "wt", encoding="utf-8")
+        self.file.write(json.dumps(header) + "\n")
+
+    def write(self, time_ns: int, pos: tuple, events: list):
+        line = [time_ns, pos[0], pos[1], [encode_event(e) for e in events]]
+        self.file.write(json.dumps(line, separators=(",", ":")) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class Player:
+    def __init__(self, filename: str):
+        self.file = gzip.open(filename, "rt", encoding="utf-8")
+        self.header = json.loads(self.file.readline())
+
+    def frames(self) -> iter:
+        # (time_ns, mouse position, events) for each frame
+        for line in self.file:
+            time_ns, x, y, events = json.loads(line)
+            yield time_ns, (x, y), [decode_event(e) for e in events]
+
+    def close(self):
+        self.file.close()
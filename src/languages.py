@@ -1,7 +1,17 @@
 import yaml
 import os
+import threading
+from collections import OrderedDict
 
 strings = dict()
+# Incremented on every language switch, so cached renders can tell when
+# their text is stale
+version = 0
+# Parsed language tables, most recently used last
+cache_size = 8
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_preloader = None
 
 
 def refresh() -> iter:
@@ -9,26 +19,69 @@ def refresh() -> iter:
         yield "src/res/lang/" + file
 
 
-def load(filename: str):
-    global strings
+def parse(filename: str) -> dict:
     text: str
     with open(filename, encoding='utf-8') as file:
         text = file.read()
-        # print(text)
-    strings = yaml.safe_load(text)
-
-
-def get_name(filename: str):
-    text: str
-    with open(filename, encoding='utf-8') as file:
-        text = file.read()
-        # print(text)
     try:
         lang = yaml.safe_load(text)
     except yaml.YAMLError as err:
         raise ValueError("Error parsing YAML file.") from err
     if type(lang) is not dict:
         raise ValueError("Invalid YAML language file.")
+    return lang
+
+
+def get_table(filename: str) -> dict:
+    with _cache_lock:
+        if filename in _cache:
+            _cache.move_to_end(filename)
+            return _cache[filename]
+    lang = parse(filename)
+    store(filename, lang)
+    return lang
+
+
+def store(filename: str, lang: dict):
+    with _cache_lock:
+        _cache[filename] = lang
+        _cache.move_to_end(filename)
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+
+
+def preload():
+    # Parse every available language in the background, so that switching
+    # language later on doesn't stall the UI thread
+    global _preloader
+    if _preloader is not None and _preloader.is_alive():
+        return
+
+    def worker():
+        for filename in refresh():
+            with _cache_lock:
+                if filename in _cache:
+                    continue
+            try:
+                store(filename, parse(filename))
+            except (OSError, ValueError):
+                # Reported when the file is requested from the UI
+                continue
+
+    _preloader = threading.Thread(target=worker, name="languages-preload", daemon=True)
+    _preloader.start()
+
+
+def load(filename: str):
+    global strings, version
+    # Swapping the table is a single assignment, so readers never see a
+    # partially loaded language
+    strings = get_table(filename)
+    version += 1
+
+
+def get_name(filename: str):
+    lang = get_table(filename)
     if "lang_name" not in lang:
         raise KeyError("lang_name")
     return lang["lang_name"]
@@ -1,10 +1,13 @@
+import argparse
 import pygame
 import ticks
 import gui
+import inputs
 import languages
 import options
 import game
 import os
+import programs
 
 
 # import math
@@ -17,59 +20,62 @@ def change_document(name):
         current_ui = name
         ui = uis[current_ui]
         ui.calc_draw(screen.get_clip())
-        ui.hover_element = ui.trace_element(pygame.mouse.get_pos())
+        ui.hover_element = ui.trace_element(inputs.get_mouse_pos())
     else:
         raise KeyError(f"{name} page does not exist.")
 
 
-# Callbacks:
-def title_start(_: gui.Element):
-    main_game.disable()
+# List rows:
+def level_row(i: int, row: gui.Element) -> gui.Element:
     document = uis["levels"]
-    lvl_list: gui.Element = document.ids["level_list"]
-    lvl_list.children.clear()
-    for i in range(main_game.unlocked_level):
-        if i >= len(levels):
-            break
-        if len(main_game.levels) <= i:
-            stars = 0
+    if row is None:
+        row = gui.Horizontal(document, "horizontal", {
+            "length": "min",
+            "margin": "5px"
+        })
+        row.add_child(gui.Button(document, "button", {
+            "on_click": "level",
+        }))
+        for j in range(3):
+            row.add_child(gui.Image(document, "image", {
+                "align": "centre",
+                "smooth": "True",
+                "margin": "5px",
+                "length": "10%",
+            }))
+    if len(main_game.levels) <= i:
+        stars = 0
+    else:
+        stars = main_game.levels[i]
+
+    button = row.children[0]
+    button.id = levels[i]
+    button.data = f"levels.{levels[i]}"
+    for j, star in enumerate(row.children[1:]):
+        if stars > j:
+            star.set_data("src/res/textures/star_full.png")
         else:
-            stars = main_game.levels[i]
+            star.set_data("src/res/textures/star_empty.png")
+    return row
 
-        button = gui.Button(ui, "button", {
-            "id": levels[i],
-            "on_click": "level",
-        })
-        button.data = f"levels.{levels[i]}"
 
-        horiz = gui.Horizontal(ui, "horizontal", {
-            "id": "level1_stars",
+def lang_row(lang: tuple, row: gui.Element) -> gui.Element:
+    if row is None:
+        row = gui.Button(uis["language"], "button", {
             "length": "min",
-            "margin": "5px"
+            "margin": "10px",
+            "on_click": "select",
         })
-        horiz.add_child(button)
-        for j in range(3):
-            if stars > j:
-                filled_star = gui.Image(ui, "image", {
-                    "align": "centre",
-                    "smooth": "True",
-                    "margin": "5px",
-                    "length": "10%",
-                    "id": f"star{j + 1}"
-                })
-                filled_star.data = "src/res/textures/star_full.png"
-                horiz.add_child(filled_star)
-            else:
-                empty_star = gui.Image(ui, "image", {
-                    "align": "centre",
-                    "smooth": "True",
-                    "margin": "5px",
-                    "length": "10%",
-                    "id": f"star{j + 1}"
-                })
-                empty_star.data = "src/res/textures/star_empty.png"
-                horiz.add_child(empty_star)
-        lvl_list.add_child(horiz)
+    row.id, row.data = lang
+    return row
+
+
+# Callbacks:
+def title_start(_: gui.Element):
+    main_game.disable()
+    document = uis["levels"]
+    lvl_list: gui.VirtualList = document.ids["level_list"]
+    lvl_list.set_rows(min(main_game.unlocked_level, len(levels)), level_row)
     change_document("levels")
 
 
@@ -82,8 +88,8 @@ def font_size_select(_: gui.Element):
 
 def title_lang(_: gui.Element):
     document = uis["language"]
-    lang_list: gui.Element = document.ids["lang_list"]
-    lang_list.children.clear()
+    lang_list: gui.VirtualList = document.ids["lang_list"]
+    langs = []
     for lang in languages.refresh():
         name: str
         try:
@@ -94,14 +100,8 @@ def title_lang(_: gui.Element):
         except KeyError as err:
             print("Invalid language YAML! " + str(err))
             continue
-        button = gui.Button(document, "button", {
-            "length": "min",
-            "margin": "10px",
-            "on_click": "select",
-            "id": lang,
-        })
-        button.data = name
-        lang_list.add_child(button)
+        langs.append((lang, name))
+    lang_list.set_rows(len(langs), lambda i, row: lang_row(langs[i], row))
     change_document("language")
 
 
@@ -116,6 +116,9 @@ def game_quit(_: gui.Element):
 
 
 def level_select(elem: gui.Element):
+    speed_button = uis["level"].ids["speed"]
+    speed_button.data = main_game.get_speed_label()
+    speed_button.invalidate()
     change_document("level")
     main_game.enable(ui, game.Level(f"src/res/levels/{elem.id}.yaml"), screen)
     # main_game.update_position(None, None, 2)
@@ -124,7 +127,7 @@ def level_select(elem: gui.Element):
 def lang_select(elem: gui.Element):
     languages.load(elem.id)
     ui.calc_draw(screen.get_clip())
-    ui.hover_element = ui.trace_element(pygame.mouse.get_pos())
+    ui.hover_element = ui.trace_element(inputs.get_mouse_pos())
 
 
 def back_title(_: gui.Element):
@@ -139,6 +142,13 @@ def back_level_select(_: gui.Element):
 def exec_code(_: gui.Element):
     main_game.run_code()
 
+
+def change_speed(elem: gui.Element):
+    main_game.next_speed()
+    elem.data = main_game.get_speed_label()
+    elem.invalidate()
+    ui.calc_draw(screen.get_clip())
+
 def select_ft_max(_: gui.Element):
     gui.init("src/res/font/JetBrainsMono-Regular.ttf",45)
 
@@ -154,13 +164,13 @@ levels = sorted([
 ])
 
 uis = {
-    "title": gui.LoaderXML("src/res/pages/title_screen.xml").get_document(),
-    "options": gui.LoaderXML("src/res/pages/options_select.xml").get_document(),
-    "font_size": gui.LoaderXML("src/res/pages/font_size_select.xml").get_document(),
-    "levels": gui.LoaderXML("src/res/pages/level_select.xml").get_document(),
-    "language": gui.LoaderXML("src/res/pages/language_select.xml").get_document(),
-    "level": gui.LoaderXML("src/res/pages/level_layout.xml").get_document(),
-    "quit": gui.LoaderXML("src/res/pages/quit_confirm.xml").get_document(),
+    "title": gui.load_page("src/res/pages/title_screen.xml"),
+    "options": gui.load_page("src/res/pages/options_select.xml"),
+    "font_size": gui.load_page("src/res/pages/font_size_select.xml"),
+    "levels": gui.load_page("src/res/pages/level_select.xml"),
+    "language": gui.load_page("src/res/pages/language_select.xml"),
+    "level": gui.load_page("src/res/pages/level_layout.xml"),
+    "quit": gui.load_page("src/res/pages/quit_confirm.xml"),
 }
 ui_callbacks = {
     "title": {
@@ -193,6 +203,7 @@ ui_callbacks = {
     "level": {
         "back": title_start,
         "play": exec_code,
+        "speed": change_speed,
     },
     "quit": {
         "quit": game_quit,
@@ -211,32 +222,80 @@ screen = pygame.display.set_mode((800, 600), pygame.RESIZABLE)
 main_game = game.Game()
 
 
-def main():
+def setup():
     pygame.display.set_caption('Code Bot')
-    clk = pygame.time.Clock()
     gui.init("src/res/font/JetBrainsMono-Regular.ttf", 30)
     game.init()
     languages.load("src/res/lang/en-gb.yaml")
+    languages.preload()
     change_document("title")
 
-    while True:
-        ticks.update()
-        ui.hover_element = ui.trace_element(pygame.mouse.get_pos())
-        for e in pygame.event.get():
-            if e.type == pygame.QUIT:
-                return
-            ui.handle_event(screen, e)
-            main_game.handle_event(screen, e)
 
-        main_game.update()
+def run_frame(events: list) -> bool:
+    # One frame of input, simulation and drawing. Returns False on quit.
+    ui.hover_element = ui.trace_element(inputs.get_mouse_pos())
+    for e in events:
+        if e.type == pygame.QUIT:
+            main_game.disable()
+            main_game.progress.close()
+            return False
+        if e.type == pygame.KEYDOWN and e.key == pygame.K_F3:
+            stats = ticks.get_stats()
+            print("Frame times over {frames} frames: mean {mean:.1f} ms, p95 {p95:.1f} ms, "
+                  "p99 {p99:.1f} ms, max {max:.1f} ms".format(**stats))
+        ui.handle_event(screen, e)
+        main_game.handle_event(screen, e)
+
+    ui.update(screen)
+    main_game.update()
+
+    ui.draw(screen)
+    main_game.draw(screen)
+    pygame.display.update()
+    return True
+
+
+def get_session_header() -> dict:
+    # Everything a replay needs to start from the same state. Programs the
+    # game can't load are left out, so the replay starts those levels empty
+    # just like the game does.
+    saved = dict()
+    for level in programs.saved_levels():
+        try:
+            saved[level] = programs.encode(programs.load(level))
+        except (ValueError, KeyError) as err:
+            print("Invalid saved program! " + str(err))
+        except OSError as err:
+            print("Could not load program! " + str(err))
+    return {
+        "size": list(screen.get_size()),
+        "unlocked": main_game.unlocked_level,
+        "levels": main_game.levels,
+        "programs": saved,
+    }
+
 
-        ui.draw(screen)
-        main_game.draw(screen)
-        pygame.display.update()
+def main(record: str = None):
+    clk = pygame.time.Clock()
+    setup()
+    if record is not None:
+        inputs.recorder = inputs.Recorder(record, get_session_header())
+
+    try:
+        while True:
+            ticks.update()
+            if not run_frame(inputs.poll()):
+                return
 
-        # Limit framerate so as to not heat up CPU unnecessarily
-        clk.tick(20)
+            # Limit framerate so as to not heat up CPU unnecessarily
+            clk.tick(20)
+    finally:
+        if inputs.recorder is not None:
+            inputs.recorder.close()
+            inputs.recorder = None
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Code Bot")
+    parser.add_argument("--record", metavar="FILE", help="record the session's input for replay.py")
+    main(parser.parse_args().record)
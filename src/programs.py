@@ -0,0 +1,117 @@
+import os
+
+# Block programs are stored as a preorder stream of opcodes: one letter per
+# block, and a repeat count followed by the children in parentheses for
+# containers, e.g. "ff4(lf)r". Programs are nested lists in memory, with
+# a (name, children) pair for each container.
+leaf_opcodes = {
+    "forward": "f",
+    "left": "l",
+    "right": "r",
+}
+repeat_counts = {
+    "repeat4": 4,
+    "repeat8": 8,
+}
+save_dir = "saves"
+# Deepest nesting of repeats accepted when decoding
+max_depth = 64
+
+_leaf_names = {v: k for k, v in leaf_opcodes.items()}
+_repeat_names = {v: k for k, v in repeat_counts.items()}
+
+
+def encode(program: list) -> str:
+    out = []
+
+    def walk(blocks: list):
+        for b in blocks:
+            if type(b) is tuple:
+                name, children = b
+                if name not in repeat_counts:
+                    raise ValueError(f"Unknown container block: {name}")
+                out.append(f"{repeat_counts[name]}(")
+                walk(children)
+                out.append(")")
+            elif b in leaf_opcodes:
+                out.append(leaf_opcodes[b])
+            else:
+                raise ValueError(f"Unknown block: {b}")
+
+    walk(program)
+    return "".join(out)
+
+
+def decode(text: str) -> list:
+    program = []
+    stack = []
+    context = program
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c in _leaf_names:
+            context.append(_leaf_names[c])
+            i += 1
+        elif c.isdigit():
+            j = i
+            while j < len(text) and text[j].isdigit():
+                j += 1
+            times = int(text[i:j])
+            if times not in _repeat_names:
+                raise ValueError(f"Invalid repeat count {times} at position {i}.")
+            if j >= len(text) or text[j] != "(":
+                raise ValueError(f"Expected '(' at position {j}.")
+            if len(stack) >= max_depth:
+                raise ValueError(f"Repeats nested deeper than {max_depth} at position {i}.")
+            children = []
+            context.append((_repeat_names[times], children))
+            stack.append(context)
+            context = children
+            i = j + 1
+        elif c == ")":
+            if len(stack) == 0:
+                raise ValueError(f"Unmatched ')' at position {i}.")
+            context = stack.pop()
+            i += 1
+        elif c.isspace():
+            i += 1
+        else:
+            raise ValueError(f"Invalid opcode '{c}' at position {i}.")
+    if len(stack) > 0:
+        raise ValueError("Unclosed repeat block.")
+    return program
+
+
+def get_path(level: str) -> str:
+    return os.path.join(save_dir, level + ".txt")
+
+
+def save(level: str, program: list):
+    os.makedirs(save_dir, exist_ok=True)
+    path = get_path(level)
+    # Written aside and renamed, so an interrupted save keeps the old one
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        file.write(encode(program) + "\n")
+    os.replace(path + ".tmp", path)
+
+
+def load(level: str) -> list:
+    try:
+        with open(get_path(level), encoding="utf-8") as file:
+            text = file.read()
+    except FileNotFoundError:
+        return []
+    return decode(text)
+
+
+def saved_levels() -> list:
+    # Names of the levels that have a saved program
+    if not os.path.isdir(save_dir):
+        return []
+    return [file[:-4] for file in sorted(os.listdir(save_dir)) if file.endswith(".txt")]
+
+
+def load_all() -> iter:
+    # Every saved program, as (level, program) pairs
+    for level in saved_levels():
+        yield level, load(level)
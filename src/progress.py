@@ -0,0 +1,160 @@
+import json
+import os
+import queue
+import threading
+
+# Progress is kept as a snapshot plus a journal of the changes made since.
+# Both kinds of entry only ever raise a value, so replaying a journal over
+# a snapshot that already includes some of it gives the same result.
+save_dir = "saves"
+compact_every = 64
+# Queued to have the worker rewrite the snapshot and journal
+_compact = object()
+
+
+def apply(state: dict, entry: dict):
+    if "unlock" in entry:
+        state["unlocked"] = max(state["unlocked"], int(entry["unlock"]))
+    if "level" in entry:
+        levels = state["levels"]
+        idx = int(entry["level"])
+        while len(levels) <= idx:
+            levels.append(0)
+        levels[idx] = max(levels[idx], int(entry["stars"]))
+
+
+class Store:
+    def __init__(self, name: str = "progress"):
+        self.snapshot_path = os.path.join(save_dir, name + ".json")
+        self.journal_path = os.path.join(save_dir, name + ".log")
+        self.state = {"unlocked": 1, "levels": []}
+        # Written to disk only by the worker thread, so the caller never
+        # waits on the file system
+        self.queue = queue.Queue()
+        self.worker = None
+        self.journal = None
+        self.pending = 0
+        # Whether the journal ends in a line cut short by a crash
+        self.torn = False
+
+    def load(self) -> dict:
+        # Read the snapshot, then replay the journal, skipping torn or
+        # corrupt lines, which are where a crash interrupted a write
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as file:
+                data = json.load(file)
+            self.state = {"unlocked": int(data["unlocked"]), "levels": [int(s) for s in data["levels"]]}
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as err:
+            print("Invalid progress snapshot! " + str(err))
+        except OSError as err:
+            print("Could not load progress! " + str(err))
+        lines = 0
+        try:
+            with open(self.journal_path, encoding="utf-8") as file:
+                for line in file:
+                    lines += 1
+                    self.torn = not line.endswith("\n")
+                    try:
+                        apply(self.state, json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            print("Could not load progress! " + str(err))
+        if lines > 0:
+            # Start from a clean journal, without the torn tail if any. Like
+            # any other write, this is left to the worker thread.
+            self.send(_compact)
+        return {"unlocked": self.state["unlocked"], "levels": list(self.state["levels"])}
+
+    def unlock(self, level: int):
+        self.record({"unlock": level})
+
+    def set_stars(self, level_idx: int, stars: int):
+        self.record({"level": level_idx, "stars": stars})
+
+    def record(self, entry: dict):
+        self.send(entry)
+
+    def send(self, item):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.write_loop, name="progress-writer", daemon=True)
+            self.worker.start()
+        self.queue.put(item)
+
+    def write_loop(self):
+        # Entries that piled up during a slow write go out together, with
+        # one sync. None is queued by close.
+        done = False
+        while not done:
+            batch = []
+            compact = False
+            entry = self.queue.get()
+            while entry is not None:
+                if entry is _compact:
+                    compact = True
+                else:
+                    batch.append(entry)
+                if self.queue.empty():
+                    break
+                entry = self.queue.get()
+            done = entry is None
+            if compact:
+                # On failure the journal is left as it is, and still read
+                # correctly on the next start
+                try:
+                    self.compact()
+                except OSError as err:
+                    print("Could not compact progress! " + str(err))
+            if len(batch) == 0:
+                continue
+            try:
+                self.append(batch)
+            except OSError as err:
+                print("Could not save progress! " + str(err))
+
+    def append(self, batch: list):
+        if self.journal is None:
+            os.makedirs(save_dir, exist_ok=True)
+            self.journal = open(self.journal_path, "a", encoding="utf-8")
+            if self.torn:
+                # Keep the first new entry off the torn line
+                self.journal.write("\n")
+                self.torn = False
+        for entry in batch:
+            apply(self.state, entry)
+            self.journal.write(json.dumps(entry) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.pending += len(batch)
+        if self.pending >= compact_every:
+            self.compact()
+
+    def compact(self):
+        # Replace the snapshot first: a crash before the journal is emptied
+        # only means its entries get applied twice
+        os.makedirs(save_dir, exist_ok=True)
+        with open(self.snapshot_path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(self.state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self.snapshot_path + ".tmp", self.snapshot_path)
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.journal = open(self.journal_path, "w", encoding="utf-8")
+        self.pending = 0
+        self.torn = False
+
+    def close(self):
+        # Wait for queued entries to reach the disk
+        if self.worker is not None:
+            self.queue.put(None)
+            self.worker.join()
+            self.worker = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
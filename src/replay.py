@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Replays a session recorded with `python src/main.py --record FILE`
+# without a window, through the same per-frame path as the game, and
+# reports how long each frame took to process.
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded Code Bot session and time its frames.")
+    parser.add_argument("session", help="file written by main.py --record")
+    parser.add_argument("-o", "--output", help="JSON lines file for per-frame timings")
+    parser.add_argument("--window", action="store_true", help="show the replay in a window")
+    args = parser.parse_args()
+    if not args.window:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+    import inputs
+    import programs
+    import progress
+    import ticks
+
+    player = inputs.Player(args.session)
+    header = player.header
+    # Start from the recorded progress, in a scratch directory so that
+    # the player's own saves are left alone
+    programs.save_dir = progress.save_dir = tempfile.mkdtemp(prefix="codebot-replay-")
+    store = progress.Store()
+    store.state = {"unlocked": header["unlocked"], "levels": header["levels"]}
+    store.compact()
+    store.close()
+    for level, text in header["programs"].items():
+        programs.save(level, programs.decode(text))
+
+    clock = ticks.FakeClock()
+    ticks.set_source(clock)
+
+    import pygame
+    import main as game_main
+    game_main.screen = pygame.display.set_mode(header["size"], pygame.RESIZABLE)
+    game_main.setup()
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else None
+    durations = []
+    try:
+        for time_ns, pos, events in player.frames():
+            clock.now = time_ns
+            ticks.update()
+            inputs.mouse_pos = pos
+            for e in events:
+                if e.type == pygame.VIDEORESIZE:
+                    game_main.screen = pygame.display.set_mode(e.size, pygame.RESIZABLE)
+            start = time.perf_counter_ns()
+            running = game_main.run_frame(events)
+            duration = time.perf_counter_ns() - start
+            durations.append(duration)
+            if out is not None:
+                out.write(json.dumps([len(durations) - 1, time_ns, duration / 1000000]) + "\n")
+            if not running:
+                break
+        else:
+            game_main.main_game.progress.close()
+    finally:
+        player.close()
+        if out is not None:
+            out.close()
+
+    stats = ticks.summarize(durations)
+    print("Replayed {frames} frames: mean {mean:.2f} ms, p95 {p95:.2f} ms, "
+          "p99 {p99:.2f} ms, max {max:.2f} ms".format(**stats), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
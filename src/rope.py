@@ -0,0 +1,199 @@
+# Immutable sequences that share structure between versions. A Rope is a
+# balanced (AVL) tree of items in order, so inserting, removing or
+# replacing an item copies only the O(log n) nodes on the path to it and
+# every other node is shared with the original. Nodes are tuples of
+# (left, item, right, size, height), with None for an empty tree.
+
+
+def _size(node) -> int:
+    return 0 if node is None else node[3]
+
+
+def _height(node) -> int:
+    return 0 if node is None else node[4]
+
+
+def _make(left, item, right) -> tuple:
+    return left, item, right, _size(left) + _size(right) + 1, max(_height(left), _height(right)) + 1
+
+
+def _balance(left, item, right) -> tuple:
+    # Join two trees whose heights differ by at most 2, rotating if needed
+    hl = _height(left)
+    hr = _height(right)
+    if hl > hr + 1:
+        ll, li, lr = left[0], left[1], left[2]
+        if _height(ll) >= _height(lr):
+            return _make(ll, li, _make(lr, item, right))
+        return _make(_make(ll, li, lr[0]), lr[1], _make(lr[2], item, right))
+    if hr > hl + 1:
+        rl, ri, rr = right[0], right[1], right[2]
+        if _height(rr) >= _height(rl):
+            return _make(_make(left, item, rl), ri, rr)
+        return _make(_make(left, item, rl[0]), rl[1], _make(rl[2], ri, rr))
+    return _make(left, item, right)
+
+
+def _build(items: list, start: int, end: int):
+    if start >= end:
+        return None
+    mid = (start + end) // 2
+    return _make(_build(items, start, mid), items[mid], _build(items, mid + 1, end))
+
+
+def _insert(node, i: int, item) -> tuple:
+    if node is None:
+        return None, item, None, 1, 1
+    left_size = _size(node[0])
+    if i <= left_size:
+        return _balance(_insert(node[0], i, item), node[1], node[2])
+    return _balance(node[0], node[1], _insert(node[2], i - left_size - 1, item))
+
+
+def _pop_first(node) -> tuple:
+    # (first item, tree without it)
+    if node[0] is None:
+        return node[1], node[2]
+    item, left = _pop_first(node[0])
+    return item, _balance(left, node[1], node[2])
+
+
+def _delete(node, i: int):
+    left_size = _size(node[0])
+    if i < left_size:
+        return _balance(_delete(node[0], i), node[1], node[2])
+    if i > left_size:
+        return _balance(node[0], node[1], _delete(node[2], i - left_size - 1))
+    if node[0] is None:
+        return node[2]
+    if node[2] is None:
+        return node[0]
+    item, right = _pop_first(node[2])
+    return _balance(node[0], item, right)
+
+
+def _replace(node, i: int, item) -> tuple:
+    left_size = _size(node[0])
+    if i < left_size:
+        return _make(_replace(node[0], i, item), node[1], node[2])
+    if i > left_size:
+        return _make(node[0], node[1], _replace(node[2], i - left_size - 1, item))
+    return node[0], item, node[2], node[3], node[4]
+
+
+def _equal(a, b) -> bool:
+    # Walk both trees in order as stacks of pending (is_item, value) parts.
+    # Versions of one rope share most of their subtrees, and those that
+    # start at the same position are skipped whole, so an edit is found
+    # without visiting the items before it.
+    stack_a = [(False, a)] if a is not None else []
+    stack_b = [(False, b)] if b is not None else []
+    while len(stack_a) > 0 and len(stack_b) > 0:
+        item_a, x = stack_a[-1]
+        item_b, y = stack_b[-1]
+        if item_a and item_b:
+            if x is not y and x != y:
+                return False
+            stack_a.pop()
+            stack_b.pop()
+            continue
+        if not item_a and not item_b and x is y:
+            stack_a.pop()
+            stack_b.pop()
+            continue
+        # Split the larger subtree into its left side, item and right side
+        if not item_a and (item_b or x[3] >= y[3]):
+            stack = stack_a
+        else:
+            stack = stack_b
+        node = stack.pop()[1]
+        if node[2] is not None:
+            stack.append((False, node[2]))
+        stack.append((True, node[1]))
+        if node[0] is not None:
+            stack.append((False, node[0]))
+    return len(stack_a) == len(stack_b)
+
+
+class Rope:
+    __slots__ = ("root",)
+
+    def __init__(self, items=()):
+        items = list(items)
+        self.root = _build(items, 0, len(items))
+
+    @staticmethod
+    def from_root(root):
+        rope = Rope.__new__(Rope)
+        rope.root = root
+        return rope
+
+    def __len__(self) -> int:
+        return _size(self.root)
+
+    def __iter__(self):
+        return self.iter_from(0)
+
+    def iter_from(self, start: int):
+        # Items from index start onwards, without visiting the ones before
+        stack = []
+        node = self.root
+        while node is not None:
+            left_size = _size(node[0])
+            if start < left_size:
+                stack.append(node)
+                node = node[0]
+            elif start == left_size:
+                stack.append(node)
+                break
+            else:
+                start -= left_size + 1
+                node = node[2]
+        while len(stack) > 0:
+            node = stack.pop()
+            yield node[1]
+            node = node[2]
+            while node is not None:
+                stack.append(node)
+                node = node[0]
+
+    def __getitem__(self, i: int):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("Rope index out of range")
+        node = self.root
+        while True:
+            left_size = _size(node[0])
+            if i == left_size:
+                return node[1]
+            if i < left_size:
+                node = node[0]
+            else:
+                i -= left_size + 1
+                node = node[2]
+
+    def insert(self, i: int, item):
+        return Rope.from_root(_insert(self.root, max(0, min(i, len(self))), item))
+
+    def delete(self, i: int):
+        if i < 0 or i >= len(self):
+            raise IndexError("Rope index out of range")
+        return Rope.from_root(_delete(self.root, i))
+
+    def replace(self, i: int, item):
+        if i < 0 or i >= len(self):
+            raise IndexError("Rope index out of range")
+        return Rope.from_root(_replace(self.root, i, item))
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Rope):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        return _equal(self.root, other.root)
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"Rope({list(self)!r})"
@@ -0,0 +1,383 @@
+import hashlib
+import json
+import os
+import sqlite3
+import yaml
+import programs
+from collections import OrderedDict
+
+# Game rules, without any rendering, so that programs can also be run
+# outside of the game window (see grade.py)
+
+# Movement for each direction the robot can face
+offsets = (
+    (0, -1),
+    (-1, 0),
+    (0, 1),
+    (1, 0),
+)
+# Map tiles
+tile_void = 0
+tile_hole = 1
+tile_goal = 3
+tile_coin = 4
+# Change in direction for each turn
+rotations = {
+    "left": 1,
+    "right": -1,
+}
+# Simulation results, most recently used last (see ResultCache)
+cache_size = 1024
+# Part of every cache key, changed whenever cached results change meaning
+cache_version = 2
+
+
+class Level:
+    def __init__(self, filename: str):
+        text: str
+        with open(filename, encoding='utf-8') as file:
+            text = file.read()
+        data = yaml.safe_load(text)
+        # Identifies the level's contents in cached results
+        self.digest = hashlib.sha1(text.encode()).hexdigest()
+        # Available blocks
+        self.blocks = data["blocks"]
+        # Map data
+        self.map = data["map"]
+        self.height = len(self.map)
+        self.width = 0
+        if self.height > 0:
+            for row in self.map:
+                if len(row) != len(self.map[0]):
+                    raise ValueError("Invalid map, inconsistent row lengths.")
+            self.width = len(self.map[0])
+
+        player = data["player"]
+        self.start_x = player["start-x"]
+        self.start_y = player["start-y"]
+        self.start_dir = player["start-dir"]
+
+        stars = data["stars"]
+        self.min_coins = stars["coins"]
+        self.min_blocks = stars["blocks"]
+
+        # Level number
+        self.number = data["number"]
+        # Name used for saved programs
+        self.name = os.path.splitext(os.path.basename(filename))[0]
+
+        self.coins = []
+        for i, row in enumerate(self.map):
+            for j, col in enumerate(row):
+                if col == tile_coin:
+                    self.coins.append((j, i))
+        # Turning only has an effect when the robot is still on a tile it
+        # hasn't reacted to, which can only be the one it starts on
+        self.turns_matter = self.get_block(self.start_x, self.start_y) in (tile_hole, tile_goal, tile_coin)
+
+    def get_block(self, x: int, y: int) -> int:
+        if x < 0 or x >= self.width or y < 0 or y >= self.height:
+            return tile_void
+        return self.map[y][x]
+
+
+class Robot:
+    def __init__(self, level: Level):
+        self.x = level.start_x
+        self.y = level.start_y
+        self.dir = level.start_dir
+        self.coins = list(level.coins)
+        self.coin_counter = 0
+        self.steps = 0
+        self.state = 0  # 1 = won, 2 = lost, 3 = ran out of steps
+
+    def copy(self):
+        robot = Robot.__new__(Robot)
+        robot.x, robot.y, robot.dir = self.x, self.y, self.dir
+        robot.coins = list(self.coins)
+        robot.coin_counter = self.coin_counter
+        robot.steps = self.steps
+        robot.state = self.state
+        return robot
+
+    def get_data(self) -> list:
+        return [self.x, self.y, self.dir, self.coins, self.coin_counter, self.steps, self.state]
+
+    @staticmethod
+    def from_data(data: list):
+        robot = Robot.__new__(Robot)
+        robot.x, robot.y, robot.dir, coins, robot.coin_counter, robot.steps, robot.state = data
+        robot.coins = [tuple(c) for c in coins]
+        return robot
+
+    def move(self, level: Level, move: str):
+        old_pos = self.x, self.y
+        if move == "forward":
+            pos_offset = offsets[self.dir]
+            self.x += pos_offset[0]
+            self.y += pos_offset[1]
+        elif move == "left":
+            self.dir = (self.dir + 1) % 4
+        elif move == "right":
+            self.dir = (self.dir - 1) % 4
+        self.steps += 1
+
+        block = level.get_block(self.x, self.y)
+
+        if (self.x, self.y) in self.coins:
+            self.coins.remove((self.x, self.y))
+            self.coin_counter += 1
+
+        if block == tile_void:
+            self.x, self.y = old_pos
+        elif block == tile_hole:
+            self.state = 2
+        elif block == tile_goal:
+            self.state = 1
+
+
+def get_stars(level: Level, robot: Robot, block_count: int) -> int:
+    if robot.state != 1:
+        return 0
+    return (
+        True,
+        block_count <= level.min_blocks,
+        robot.coin_counter >= level.min_coins
+    ).count(True)
+
+
+def get_moves(program: list):
+    # Moves of a program in the nested list form of programs.py. Walked
+    # with a stack rather than recursion, so nesting depth isn't limited.
+    stack = [iter(program)]
+    while len(stack) > 0:
+        b = next(stack[-1], None)
+        if b is None:
+            stack.pop()
+        elif type(b) is tuple:
+            name, children = b
+            stack.append(iter(children * programs.repeat_counts[name]))
+        else:
+            yield b
+
+
+def count_blocks(program: list) -> int:
+    count = 0
+    stack = [program]
+    while len(stack) > 0:
+        blocks = stack.pop()
+        count += len(blocks)
+        stack.extend(b[1] for b in blocks if type(b) is tuple)
+    return count
+
+
+def run(level: Level, program: list, max_steps: int = -1) -> Robot:
+    # Runs until the robot wins, loses or the program ends. Reaching
+    # max_steps with moves left stops it too, with state 3.
+    robot = Robot(level)
+    for move in get_moves(program):
+        if robot.steps == max_steps:
+            robot.state = 3
+            break
+        robot.move(level, move)
+        if robot.state > 0:
+            break
+    return robot
+
+
+def canonical(program: list) -> list:
+    # An equivalent program without redundant turns: each run of turns is
+    # reduced to its net rotation, and repeats that only turn the robot are
+    # merged into the turns around them. Equivalent as long as turning
+    # doesn't affect anything but the direction (see Level.turns_matter),
+    # though it may take fewer steps. Containers are rewritten from the
+    # innermost out, with a stack of [blocks left, output, net turn, name].
+    def flush(frame: list):
+        turn = frame[2]
+        frame[1].extend(("left",) * turn if turn < 3 else ("right",))
+        frame[2] = 0
+
+    stack = [[iter(program), [], 0, None]]
+    while True:
+        frame = stack[-1]
+        b = next(frame[0], None)
+        if b is None:
+            flush(frame)
+            stack.pop()
+            if len(stack) == 0:
+                return frame[1]
+            parent = stack[-1]
+            body, name = frame[1], frame[3]
+            if all(type(c) is str and c in rotations for c in body):
+                net = sum(rotations[c] for c in body)
+                parent[2] = (parent[2] + net * programs.repeat_counts[name]) % 4
+            else:
+                flush(parent)
+                parent[1].append((name, body))
+        elif type(b) is tuple:
+            stack.append([iter(b[1]), [], 0, b[0]])
+        elif b in rotations:
+            frame[2] = (frame[2] + rotations[b]) % 4
+        else:
+            flush(frame)
+            frame[1].append(b)
+
+
+def get_counts(program: list) -> dict:
+    # Moves and forward moves in one pass over each list of blocks in a
+    # program, by the list's id. Inner lists are counted first.
+    counts = dict()
+    stack = [(program, False)]
+    while len(stack) > 0:
+        blocks, ready = stack.pop()
+        if not ready:
+            stack.append((blocks, True))
+            stack.extend((b[1], False) for b in blocks if type(b) is tuple)
+            continue
+        moves = forwards = 0
+        for b in blocks:
+            if type(b) is tuple:
+                times = programs.repeat_counts[b[0]]
+                sub = counts[id(b[1])]
+                moves += sub[0] * times
+                forwards += sub[1] * times
+            else:
+                moves += 1
+                forwards += b == "forward"
+        counts[id(blocks)] = (moves, forwards)
+    return counts
+
+
+def get_prefix(program: list, counts: dict, limit: int, by: int) -> tuple:
+    # (moves, forward moves) made by the time the count picked by `by`
+    # (0 for moves, 1 for forward moves) reaches limit, or the program
+    # ends. Whole repeats are skipped using counts, see get_counts.
+    done = [0, 0]
+    blocks = program
+    while done[by] < limit:
+        for b in blocks:
+            if type(b) is tuple:
+                times = programs.repeat_counts[b[0]]
+                sub = counts[id(b[1])]
+                if done[by] + sub[by] * times < limit:
+                    done[0] += sub[0] * times
+                    done[1] += sub[1] * times
+                    continue
+                # The limit is reached in this repeat: skip the iterations
+                # before that and continue inside it
+                skipped = (limit - done[by] - 1) // sub[by]
+                done[0] += sub[0] * skipped
+                done[1] += sub[1] * skipped
+                blocks = b[1]
+                break
+            done[0] += 1
+            done[1] += b == "forward"
+            if done[by] == limit:
+                break
+        else:
+            break
+    return done[0], done[1]
+
+
+class ResultCache:
+    def __init__(self, size: int = cache_size, path: str = None):
+        self.size = size
+        self.entries = OrderedDict()
+        # Optional second tier on disk, shared between runs and processes
+        self.db = None
+        if path is not None:
+            try:
+                self.db = sqlite3.connect(path, timeout=5)
+                self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, data TEXT)")
+                self.db.commit()
+            except sqlite3.Error as err:
+                print("Result cache unavailable! " + str(err))
+                self.db = None
+
+    def get(self, key: str):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return Robot.from_data(self.entries[key])
+        if self.db is None:
+            return None
+        try:
+            row = self.db.execute("SELECT data FROM results WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as err:
+            print("Result cache unavailable! " + str(err))
+            self.db = None
+            return None
+        if row is None:
+            return None
+        data = json.loads(row[0])
+        self.store(key, data)
+        return Robot.from_data(data)
+
+    def put(self, key: str, robot: Robot):
+        data = robot.get_data()
+        self.store(key, data)
+        if self.db is None:
+            return
+        try:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?)", (key, json.dumps(data)))
+        except sqlite3.Error as err:
+            print("Result cache unavailable! " + str(err))
+            self.db = None
+
+    def flush(self):
+        # New results only reach the disk tier when flushed
+        if self.db is None:
+            return
+        try:
+            self.db.commit()
+        except sqlite3.Error as err:
+            print("Result cache unavailable! " + str(err))
+            self.db = None
+
+    def store(self, key: str, data: list):
+        self.entries[key] = data
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+results = ResultCache()
+
+
+def lookup(level: Level, program: list, max_steps: int, cache: ResultCache) -> Robot:
+    # run, for this exact program, looked up in the cache first
+    text = programs.encode(program)
+    key = f"{cache_version}:{level.digest}:{max_steps}:{hashlib.sha1(text.encode()).hexdigest()}"
+    robot = cache.get(key)
+    if robot is None:
+        robot = run(level, program, max_steps)
+        cache.put(key, robot)
+    return robot
+
+
+def run_cached(level: Level, program: list, max_steps: int = -1, cache: ResultCache = None) -> Robot:
+    # Like run, but equivalent programs are only simulated once per level,
+    # as their canonical program. Only the steps differ between them; those
+    # are counted for the program itself, and so is max_steps.
+    if cache is None:
+        cache = results
+    if level.turns_matter:
+        return lookup(level, program, max_steps, cache)
+    canon = canonical(program)
+    robot = lookup(level, canon, max_steps, cache)
+    if canon == program:
+        return robot
+    if robot.state == 3:
+        # Dropping turns only saves steps, so the program runs out too,
+        # though maybe somewhere else
+        return lookup(level, program, max_steps, cache)
+    counts = get_counts(program)
+    if robot.state == 0:
+        steps = counts[id(program)][0]
+    else:
+        # Winning or losing takes a forward move, the same one in both
+        forwards = get_prefix(canon, get_counts(canon), robot.steps, 0)[1]
+        steps = get_prefix(program, counts, forwards, 1)[0]
+    if 0 <= max_steps < steps:
+        return lookup(level, program, max_steps, cache)
+    robot.steps = steps
+    return robot
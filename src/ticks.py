@@ -1,18 +1,79 @@
-import pygame
+import time
+from collections import deque
 
+# Clock read once per frame. Times are in milliseconds, counted from when
+# the clock source was set; the source itself returns nanoseconds.
+source = time.monotonic_ns
+origin: int = source()
 delta: int = -1
 ticks: int = -1
+ticks_ns: int = -1
+# Durations of the most recent frames, in nanoseconds
+stats_window = 240
+frame_times = deque(maxlen=stats_window)
+
+
+class FakeClock:
+    # Deterministic clock source for tests and benchmarks: time only moves
+    # when advanced, or by a fixed step every time it is read
+    def __init__(self, step_ms: float = 0):
+        self.now = 0
+        self.step = int(step_ms * 1000000)
+
+    def __call__(self) -> int:
+        now = self.now
+        self.now += self.step
+        return now
+
+    def advance(self, ms: float):
+        self.now += int(ms * 1000000)
+
+
+def set_source(new_source=time.monotonic_ns):
+    global source, origin, delta, ticks, ticks_ns
+    source = new_source
+    origin = source()
+    delta = ticks = ticks_ns = -1
+    frame_times.clear()
 
 
 def update() -> None:
-    global delta, ticks
+    global delta, ticks, ticks_ns
+    now = source() - origin
+    if ticks_ns >= 0:
+        frame_times.append(now - ticks_ns)
+    ticks_ns = now
     delta = ticks
-    ticks = pygame.time.get_ticks()
+    ticks = now // 1000000
 
 
 def get_time() -> int:
     return ticks
 
 
+def get_time_ns() -> int:
+    return ticks_ns
+
+
 def get_variation() -> int:
     return ticks - delta
+
+
+def get_stats() -> dict:
+    # Frame time statistics over the recent frames, in milliseconds
+    return summarize(frame_times)
+
+
+def summarize(durations) -> dict:
+    # Statistics of durations given in nanoseconds, in milliseconds
+    if len(durations) == 0:
+        return {"frames": 0, "mean": 0, "p95": 0, "p99": 0, "max": 0}
+    ordered = sorted(durations)
+    n = len(ordered)
+    return {
+        "frames": n,
+        "mean": sum(ordered) / n / 1000000,
+        "p95": ordered[min(n - 1, n * 95 // 100)] / 1000000,
+        "p99": ordered[min(n - 1, n * 99 // 100)] / 1000000,
+        "max": ordered[-1] / 1000000,
+    }